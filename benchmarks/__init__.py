@@ -0,0 +1,24 @@
+""" Paquete de benchmarks de la aplicación.
+
+Contiene tres herramientas que trabajan sobre una base de datos SQLite desechable:
+
+  - seed: genera de forma reproducible (con semilla) proveedores, productos, ventas y
+    usuarios de prueba.
+      python -m benchmarks.seed --db /tmp/bench.db --suppliers 100 --products 10000 --sales 100000
+
+  - harness: recorre las rutas principales con el cliente de pruebas de Flask y guarda en
+    JSON la latencia (p50/p95/p99), las consultas SQL por petición y el pico de memoria.
+      python -m benchmarks.harness --db /tmp/bench.db --requests 200 --output results.json
+      python -m benchmarks.harness --db /tmp/bench.db --baseline results.json
+
+  - startup: mide el tiempo de importación y la memoria de arranque de la aplicación, con
+    plotly cargado bajo demanda o por adelantado.
+      python -m benchmarks.startup --runs 10
+
+Todas apuntan la aplicación a la base de datos indicada mediante DATABASE_URL antes de
+importar main, así que nunca tocan instance/database.db. """
+
+
+def database_url(path):
+    import os
+    return 'sqlite:///' + os.path.abspath(path)
@@ -0,0 +1,160 @@
+""" Banco de pruebas de latencia de la aplicación.
+
+Lanza peticiones contra las rutas principales con el cliente de pruebas de Flask (sin red ni
+servidor, así que se mide solo el coste de la aplicación y la base de datos) y calcula por
+ruta la latencia p50/p95/p99, la primera petición en frío, las consultas SQL por petición y
+el pico de memoria residente del proceso. Los resultados se guardan en JSON y pueden
+compararse con una ejecución anterior para detectar regresiones. """
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from datetime import datetime
+
+from benchmarks import database_url
+
+
+def percentile(sorted_values, fraction):
+    # Percentil por el método del rango más cercano sobre una lista ya ordenada
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_kb():
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def build_scenarios(rng, product_count):
+    # Cada escenario es (nombre, función que hace una petición con el cliente). Las rutas de
+    # solo lectura van primero; add_sale modifica los datos e invalida las cachés.
+    def login(client):
+        return client.post('/login', data={'username': 'admin', 'password': 'admin'})
+
+    def get(path):
+        return lambda client: client.get(path)
+
+    def add_sale(client):
+        return client.post('/add_sale', data={'product': rng.randrange(1, product_count + 1), 'quantity': 1})
+
+    return [
+        ('login', login),
+        ('dashboard', get('/dashboard')),
+        ('charts', get('/charts')),
+        ('sales_chart', get('/sales_chart')),
+        ('profits_chart', get('/profits_chart')),
+        ('api_charts_sales', get('/api/charts/sales')),
+        ('api_charts_profits', get('/api/charts/profits')),
+        ('add_sale', add_sale),
+    ]
+
+
+def run(path, requests, seed_value):
+    os.environ['DATABASE_URL'] = database_url(path)
+    import main
+    from sqlalchemy import event
+
+    query_count = [0]
+    with main.app.app_context():
+        event.listen(main.db.engine, 'before_cursor_execute', lambda *args: query_count.__setitem__(0, query_count[0] + 1))
+        product_count = main.db.session.query(main.func.max(main.Product.id)).scalar() or 1
+
+    client = main.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+
+    results = {}
+    for name, request in build_scenarios(random.Random(seed_value), product_count):
+        timings = []
+        queries = []
+        for _ in range(requests):
+            query_count[0] = 0
+            started = time.perf_counter()
+            response = request(client)
+            timings.append((time.perf_counter() - started) * 1000)
+            queries.append(query_count[0])
+            if response.status_code >= 400:
+                raise SystemExit(f'{name}: HTTP {response.status_code}')
+            response.close()
+
+        ordered = sorted(timings)
+        results[name] = {
+            'requests': requests,
+            'first_ms': round(timings[0], 3),
+            'p50_ms': round(percentile(ordered, 0.50), 3),
+            'p95_ms': round(percentile(ordered, 0.95), 3),
+            'p99_ms': round(percentile(ordered, 0.99), 3),
+            'queries_per_request': round(sum(queries) / len(queries), 2),
+            'peak_rss_kb': peak_rss_kb(),
+        }
+        print(f"{name:18} p50 {results[name]['p50_ms']:9.2f} ms  p95 {results[name]['p95_ms']:9.2f} ms  "
+              f"p99 {results[name]['p99_ms']:9.2f} ms  queries {results[name]['queries_per_request']:6.2f}  "
+              f"rss {results[name]['peak_rss_kb'] // 1024} MB")
+
+    with main.app.app_context():
+        counts = {model.__tablename__: main.db.session.query(model).count() for model in (main.Supplier, main.Product, main.Sale)}
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': os.path.abspath(path),
+            'rows': counts,
+            'requests': requests,
+            'seed': seed_value,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold):
+    # Muestra la variación de p50 y p95 respecto a la ejecución de referencia y devuelve las
+    # rutas cuyo p95 ha empeorado más del umbral (en porcentaje).
+    regressions = []
+    for name, result in current['results'].items():
+        previous = baseline['results'].get(name)
+        if not previous:
+            continue
+        changes = {}
+        for metric in ('p50_ms', 'p95_ms'):
+            changes[metric] = (result[metric] - previous[metric]) / previous[metric] * 100 if previous[metric] else 0.0
+        print(f"{name:18} p50 {changes['p50_ms']:+7.1f}%  p95 {changes['p95_ms']:+7.1f}%")
+        if changes['p95_ms'] > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Mide la latencia de las rutas principales de la aplicación.')
+    parser.add_argument('--db', required=True, help='base de datos creada con benchmarks.seed')
+    parser.add_argument('--requests', type=int, default=100, help='peticiones por ruta')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='fichero JSON donde guardar los resultados')
+    parser.add_argument('--baseline', help='resultados JSON de una ejecución anterior para comparar')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='empeoramiento máximo de p95 (en %%) antes de considerarlo una regresión')
+    args = parser.parse_args()
+
+    current = run(args.db, args.requests, args.seed)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(json.load(f), current, args.threshold)
+        if regressions:
+            raise SystemExit(f"p95 regressions over {args.threshold}%: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,139 @@
+""" Generador de datos sintéticos para los benchmarks.
+
+Rellena una base de datos SQLite desechable con el número de proveedores, productos y ventas
+indicado (hasta 1.000 proveedores, 1.000.000 de productos y 10.000.000 de ventas). Con la
+misma semilla se generan siempre los mismos datos. Las filas se insertan por bloques con
+executemany directamente sobre la conexión de SQLite y al final se recalculan las tablas
+derivadas (agregados por proveedor y por periodo y déficit de stock). """
+
+import argparse
+import os
+import random
+import time
+from datetime import date, timedelta
+
+from benchmarks import database_url
+
+MAX_SUPPLIERS = 1000
+MAX_PRODUCTS = 1000000
+MAX_SALES = 10000000
+CHUNK_SIZE = 50000
+
+
+def chunked(rows, size=CHUNK_SIZE):
+    # Agrupa un generador de filas en listas de como mucho size elementos
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def generate_suppliers(rng, count):
+    for supplier_id in range(1, count + 1):
+        yield (supplier_id, f'Supplier {supplier_id:04d}', f'9{rng.randrange(10 ** 8):08d}',
+               f'Calle {rng.randrange(1, 500)}', f'B{rng.randrange(10 ** 8):08d}')
+
+
+def generate_products(rng, count, suppliers):
+    # Devuelve las filas de productos y guarda en listas paralelas los datos que necesitan
+    # las ventas (proveedor y precios), para no tener que volver a leerlos.
+    supplier_ids, costs, prices = [], [], []
+
+    def rows():
+        for product_id in range(1, count + 1):
+            supplier_id = rng.randrange(1, suppliers + 1)
+            cost = round(rng.uniform(1, 500), 2)
+            price = round(cost * rng.uniform(1.05, 1.8), 2)
+            quantity = rng.randrange(10, 1000)
+            supplier_ids.append(supplier_id)
+            costs.append(cost)
+            prices.append(price)
+            yield (product_id, f'Product {product_id:07d}', f'Synthetic product {product_id}', cost, price,
+                   rng.randrange(0, quantity + 1), quantity, supplier_id)
+
+    return rows(), supplier_ids, costs, prices
+
+
+def generate_sales(rng, count, supplier_ids, costs, prices, days):
+    first_day = date.today() - timedelta(days=days - 1)
+    product_count = len(supplier_ids)
+    for sale_id in range(1, count + 1):
+        index = rng.randrange(product_count)
+        quantity = rng.randrange(1, 10)
+        price, cost = prices[index], costs[index]
+        supplier_id = supplier_ids[index]
+        sale_date = first_day + timedelta(days=rng.randrange(days))
+        yield (sale_id, sale_date.isoformat(), index + 1, supplier_id, f'Product {index + 1:07d}',
+               f'Supplier {supplier_id:04d}', quantity, price, price * quantity, cost * quantity,
+               (price - cost) * quantity)
+
+
+def seed(path, suppliers, products, sales, days, seed_value):
+    # Crea la base de datos en path (borrando la anterior) y la rellena
+    if not (1 <= suppliers <= MAX_SUPPLIERS and 1 <= products <= MAX_PRODUCTS and 0 <= sales <= MAX_SALES):
+        raise SystemExit(f'Limits: suppliers 1-{MAX_SUPPLIERS}, products 1-{MAX_PRODUCTS}, sales 0-{MAX_SALES}')
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    os.environ['DATABASE_URL'] = database_url(path)
+    import main
+
+    rng = random.Random(seed_value)
+    started = time.perf_counter()
+
+    with main.app.app_context():
+        main.init_database()
+        connection = main.db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('PRAGMA synchronous = OFF')
+
+            cursor.executemany('INSERT INTO supplier (id, company_name, phone, address, cif) VALUES (?, ?, ?, ?, ?)',
+                               list(generate_suppliers(rng, suppliers)))
+
+            product_rows, supplier_ids, costs, prices = generate_products(rng, products, suppliers)
+            for chunk in chunked(product_rows):
+                cursor.executemany(
+                    'INSERT INTO product (id, name, description, precio_costo, precio_venta, stock, quantity, supplier_id) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', chunk)
+
+            for chunk in chunked(generate_sales(rng, sales, supplier_ids, costs, prices, days)):
+                cursor.executemany(
+                    'INSERT INTO sale (id, sale_date, product_id, supplier_id, product_name, supplier_name, quantity, '
+                    'selling_price, total_price, cost_price, total_profit) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', chunk)
+
+            cursor.executemany('INSERT INTO user (username, password, email, is_admin) VALUES (?, ?, ?, ?)',
+                               [('admin', 'admin', 'admin@example.com', True), ('client', 'client', 'client@example.com', False)])
+            connection.commit()
+        finally:
+            connection.close()
+
+        main.refresh_stock_shortfall()
+        main.db.session.commit()
+        main.rebuild_supplier_stats()
+        main.rebuild_sale_rollups()
+
+    print(f'Seeded {suppliers} suppliers, {products} products and {sales} sales into {path} '
+          f'in {time.perf_counter() - started:.1f}s')
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Genera una base de datos SQLite sintética para los benchmarks.')
+    parser.add_argument('--db', required=True, help='ruta del fichero SQLite a crear (se sobrescribe)')
+    parser.add_argument('--suppliers', type=int, default=100)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--sales', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=365, help='días de historial sobre los que se reparten las ventas')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    seed(args.db, args.suppliers, args.products, args.sales, args.days, args.seed)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,74 @@
+""" Medición del coste de arranque de la aplicación.
+
+Lanza varias veces un intérprete nuevo que importa main (lo que crea la aplicación por
+defecto) y mide el tiempo de importación y la memoria residente resultante. Compara la
+importación actual, que deja plotly para el primer gráfico, con una importación que carga
+plotly por adelantado como hacía la aplicación antes de create_app(), y con un intérprete
+que solo importa Flask y SQLAlchemy como referencia.
+    python -m benchmarks.startup --runs 10 --output startup.json """
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks import database_url
+
+SCENARIOS = {
+    'baseline': 'import flask, flask_sqlalchemy',
+    'lazy': 'import main',
+    'eager': 'import plotly.graph_objects, plotly.offline, plotly.subplots; import main',
+}
+
+PROBE = '''
+import resource, sys, time
+started = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - started
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed * 1000, peak // 1024 if sys.platform == 'darwin' else peak)
+'''
+
+
+def measure(statement, runs, env):
+    # Ejecuta la sentencia en runs procesos nuevos y devuelve los tiempos (ms) y RSS (KB)
+    timings, peaks = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(statement=statement)],
+                                env=env, check=True, capture_output=True, text=True).stdout
+        elapsed, peak = output.split()
+        timings.append(float(elapsed))
+        peaks.append(int(peak))
+    return {
+        'median_ms': round(statistics.median(timings), 2),
+        'min_ms': round(min(timings), 2),
+        'peak_rss_kb': max(peaks),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Mide el tiempo de importación y la memoria de arranque de la aplicación.')
+    parser.add_argument('--runs', type=int, default=10, help='procesos por escenario')
+    parser.add_argument('--output', help='fichero JSON donde guardar los resultados')
+    args = parser.parse_args()
+
+    # La aplicación no toca la base de datos al importarse, pero se apunta igualmente a una
+    # desechable para no depender de instance/database.db.
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_URL=database_url(os.path.join(directory, 'startup.db')))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+        results = {name: measure(statement, args.runs, env) for name, statement in SCENARIOS.items()}
+
+    for name, result in results.items():
+        print(f"{name:10} median {result['median_ms']:8.1f} ms  min {result['min_ms']:8.1f} ms  rss {result['peak_rss_kb']:8d} KB")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
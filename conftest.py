@@ -0,0 +1,3 @@
+# Configuración de pytest en la raíz del proyecto. Su presencia hace que pytest añada este
+# directorio a sys.path, de modo que las pruebas de tests/ pueden importar main, forecast y
+# metrics tanto con "pytest" como con "python -m pytest".
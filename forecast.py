@@ -0,0 +1,66 @@
+# Previsión de reposición: velocidad de venta, días de stock y cantidad a pedir por producto.
+import numpy as np
+
+
+class RestockForecast:
+    """ Clase RestockForecast.
+    Calcula la previsión de reposición de todos los productos a la vez con operaciones
+    vectorizadas de NumPy, sin recorrer objetos de Python. Las ventas diarias se suman por
+    bloques con add_sales (np.bincount sobre el índice de cada producto), así que la memoria
+    depende del número de productos y del tamaño del bloque, no del historial.
+    La velocidad de venta es la media diaria de la ventana con pesos que decaen a la mitad
+    cada half_life_days días, de modo que las ventas recientes pesan más.
+    args:
+      -product_ids: Son los ids de los productos ordenados de menor a mayor, es un array de int.
+      -stock: Es el stock actual de cada producto, en el mismo orden, es un array de float.
+      -window_days: Es el número de días de historial que se tienen en cuenta, es de tipo int.
+      -half_life_days: Es el número de días en que el peso de una venta se reduce a la
+       mitad, es de tipo float."""
+
+
+    def __init__(self, product_ids, stock, window_days, half_life_days):
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.stock = np.asarray(stock, dtype=np.float64)
+        self.window_days = window_days
+        self.decay = 0.5 ** (np.arange(window_days) / half_life_days)
+        self.weighted_units = np.zeros(len(self.product_ids))
+        self.units = np.zeros(len(self.product_ids))
+        self.squared_units = np.zeros(len(self.product_ids))
+
+    def add_sales(self, product_ids, ages, units):
+        # Suma un bloque de ventas diarias: el id del producto, la antigüedad del día en días
+        # (0 es hoy) y las unidades vendidas ese día. Se descartan los productos que ya no
+        # existen y los días fuera de la ventana.
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        ages = np.asarray(ages, dtype=np.int64)
+        units = np.asarray(units, dtype=np.float64)
+        count = len(self.product_ids)
+        if count == 0 or len(product_ids) == 0:
+            return
+
+        index = np.searchsorted(self.product_ids, product_ids)
+        valid = ((index < count) & (self.product_ids[np.minimum(index, count - 1)] == product_ids)
+                 & (ages >= 0) & (ages < self.window_days))
+        index, ages, units = index[valid], ages[valid], units[valid]
+
+        self.weighted_units += np.bincount(index, weights=units * self.decay[ages], minlength=count)
+        self.units += np.bincount(index, weights=units, minlength=count)
+        self.squared_units += np.bincount(index, weights=units * units, minlength=count)
+
+    def result(self, lead_time_days, cover_days, service_z):
+        # Devuelve tres arrays con, para cada producto, la velocidad de venta (unidades al
+        # día), los días de stock que quedan a esa velocidad (inf si no se vende) y la
+        # cantidad a pedir para cubrir el plazo de entrega más cover_days días, con un stock
+        # de seguridad de service_z desviaciones típicas de la demanda durante el plazo.
+        velocity = self.weighted_units / self.decay.sum()
+
+        mean = self.units / self.window_days
+        deviation = np.sqrt(np.maximum(self.squared_units / self.window_days - mean * mean, 0))
+        safety_stock = service_z * deviation * np.sqrt(lead_time_days)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            days_remaining = np.where(velocity > 0, self.stock / velocity, np.inf)
+
+        target = velocity * (lead_time_days + cover_days) + safety_stock
+        reorder_quantity = np.ceil(np.maximum(target - self.stock, 0))
+        return velocity, days_remaining, reorder_quantity
@@ -0,0 +1,24 @@
+# Configuración de gunicorn: gunicorn -c gunicorn.conf.py main:app
+#
+# Con preload_app la aplicación se importa una sola vez en el proceso maestro antes de crear
+# los workers. El maestro precarga además plotly y congela los objetos existentes para el
+# recolector de basura, de forma que los workers comparten esa memoria por copy-on-write en
+# lugar de duplicarla. Cada worker descarta las conexiones heredadas del maestro.
+import gc
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', '4'))
+preload_app = True
+
+
+def when_ready(server):
+    import main
+    main.preload_heavy_modules(main.app)
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import main
+    with main.app.app_context():
+        main.db.engine.dispose(close=False)
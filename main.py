@@ -1,18 +1,64 @@
 # Primero importamos las librerías necesarias.
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Blueprint, Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, Response, current_app, has_app_context, stream_with_context
+from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-
-
-""" A continuación, creamos una instancia de la aplicación Flask, se establece una clave
-secreta y se configura la URI de la base de datos. Además, se crea una instancia de 
-SQLAlchemy para interactuar con la base de datos. """
-app = Flask(__name__)
-app.secret_key = 'mysecretkey'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
-db = SQLAlchemy(app)
+from sqlalchemy import func, tuple_, event, and_, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import contains_eager, Session as SASession
+from werkzeug.http import is_resource_modified
+from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import datetime, date, timedelta, timezone
+import base64
+import multiprocessing
+import csv
+import io
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+import os
+import re
+import unicodedata
+import zlib
+import gzip
+import hashlib
+import click
+import importlib.metadata
+from metrics import RequestMetrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+""" A continuación, se crea la instancia de SQLAlchemy para interactuar con la base de datos.
+ Se asocia a la aplicación en create_app(), al final de este archivo. """
+db = SQLAlchemy()
+
+
+""" Rutas. Las vistas se registran en el blueprint bp, que create_app() añade a cada
+ aplicación que crea; sus endpoints llevan el prefijo "main." (por ejemplo main.dashboard). """
+bp = Blueprint('main', __name__)
+
+
+""" Ajustes de SQLite. Cada conexión nueva activa el modo de diario configurado (WAL permite
+ lecturas concurrentes con una escritura), el nivel de sincronización y un tiempo de espera
+ para que los escritores hagan cola en lugar de fallar con "database is locked". """
+def configure_sqlite(engine, config):
+    @event.listens_for(engine, 'connect')
+    def configure_sqlite_connection(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}")
+        cursor.execute(f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}")
+        cursor.close()
 
 
 """ A continuación, se definen los modelos de la base de datos. Cada modelo es una clase y
@@ -22,7 +68,7 @@ class Product(db.Model):
     """ Clase Product.
     Hace referencia a la tabla de productos en la cual guardamos los datos de cada producto.
     Contiene los atributos: id, name, description, precio_costo, precio_venta, stock, 
-    quantity y supplier_id.
+    quantity, supplier_id, low_stock_threshold y stock_shortfall.
     args:
       -id: Es el identificador del producto, es de tipo int y es la clave primaria.
       -name: Es el nombre del producto, es de tipo str y no puede ser nulo.
@@ -33,17 +79,33 @@ class Product(db.Model):
        nulo.
       -stock, quantity: Es la cantidad de productos en stock, es de tipo int y no puede ser 
        nulo.
-      -supplier_id: Es el identificador del proveedor, es de tipo int y no puede ser nulo. """
-
+      -supplier_id: Es el identificador del proveedor, es de tipo int y no puede ser nulo.
+      -low_stock_threshold: Es la fracción de quantity por debajo de la cual el producto tiene
+       bajo stock, es de tipo float. Si es nulo se usa la del proveedor o la global.
+      -stock_shortfall: Es la fracción de quantity que falta para llegar al umbral de bajo
+       stock, es de tipo float y está indexado. Es mayor o igual que cero cuando el producto
+       tiene bajo stock y se mantiene al día en cada venta y alta de producto. """
+
+
+    # Índices (columna, id) para las columnas por las que se puede ordenar el panel (ver
+    # PRODUCT_SORT_COLUMNS), de modo que cada página por cursor sea una búsqueda en el índice
+    __table_args__ = (
+        db.Index('ix_product_precio_costo_id', 'precio_costo', 'id'),
+        db.Index('ix_product_precio_venta_id', 'precio_venta', 'id'),
+        db.Index('ix_product_stock_id', 'stock', 'id'),
+        db.Index('ix_product_quantity_id', 'quantity', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(50), nullable=False, index=True)
     description = db.Column(db.String(200), nullable=False)
     precio_costo = db.Column(db.Float, nullable=False)
     precio_venta = db.Column(db.Float, nullable=False)
     stock = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)  
     supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), nullable=False)
+    low_stock_threshold = db.Column(db.Float)
+    stock_shortfall = db.Column(db.Float, index=True)
 
     """ El método __repr__ nos aporta una representación legible en cadena del objeto. """
     def __repr__(self):
@@ -53,21 +115,24 @@ class Product(db.Model):
 class Supplier(db.Model):
     """ Clase Supplier.
     Hace referencia a la tabla de proveedores en la cual guardamos los datos de cada proveedor.
-    Contiene los atributos: id, company_name, phone, address, cif y products.
+    Contiene los atributos: id, company_name, phone, address, cif, low_stock_threshold y products.
     args:
       -id: Es el identificador del producto, es de tipo int y es la clave primaria.
       -company_name: Es el nombre de la empresa, es de tipo str y no puede ser nulo.
       -phone: Es el número de teléfono de la empresa, es de tipo str y no puede ser nulo.
       -address: Es la dirección de la empresa, es de tipo str y no puede ser nulo.
       -cif: Es el CIF de la empresa, es de tipo str y no puede ser nulo.
+      -low_stock_threshold: Es el umbral de bajo stock por defecto de los productos del
+       proveedor, es de tipo float y puede ser nulo.
       -products: Es la relación con la tabla Product, es de tipo str y no puede ser nulo."""
 
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    company_name = db.Column(db.String(50), nullable=False)
+    company_name = db.Column(db.String(50), nullable=False, index=True)
     phone = db.Column(db.String(20), nullable=False)
     address = db.Column(db.String(200), nullable=False)
     cif = db.Column(db.String(20), nullable=False)
+    low_stock_threshold = db.Column(db.Float)
     products = db.relationship('Product', backref='supplier', lazy=True)
 
     """ El método __repr__ nos aporta una representación legible en cadena del objeto. """
@@ -80,7 +145,8 @@ class User(db.Model):
     Contiene los atributos: id, username, password, email e is_admin.
     args:
       -id: Es el identificador del producto, es de tipo int y es la clave primaria.
-      -username: Es el nombre de usuario, es de tipo str y no puede ser nulo.
+      -username: Es el nombre de usuario, es de tipo str, no puede ser nulo y es único
+       (tiene un índice único, que usa la consulta del login).
       -password: Es la contraseña del usuario, es de tipo str y no puede ser nulo.
       -email: Es el correo electrónico del usuario, es de tipo str y no puede ser nulo.
       -is_admin: Es un booleano que indica si el usuario es administrador o no, es de tipo
@@ -88,7 +154,7 @@ class User(db.Model):
 
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    username = db.Column(db.String(50), nullable=False)
+    username = db.Column(db.String(50), nullable=False, unique=True, index=True)
     password = db.Column(db.String(50), nullable=False)
     email = db.Column(db.String(50), nullable=False)
     is_admin = db.Column(db.Boolean, nullable=False, default=False)
@@ -101,12 +167,18 @@ class User(db.Model):
 class Sale(db.Model):
     """ Clase Sale.
     Hace referencia a la tabla de ventas en la cual guardamos los datos de cada venta.
-    Contiene los atributos: id, sale_date, product_name, supplier_name, quantity, selling_price,
+    Contiene los atributos: id, sale_date, product_id, supplier_id, product_name, supplier_name,
+    quantity, selling_price,
     args:
       -id: Es el identificador del producto, es de tipo int y es la clave primaria.
-      -sale_date: Es la fecha de la venta, es de tipo date y no puede ser nulo.
-      -product_name: Es el nombre del producto, es de tipo str y no puede ser nulo.
-      -supplier_name: Es el nombre del proveedor, es de tipo str y no puede ser nulo.
+      -sale_date: Es la fecha de la venta, es de tipo date, no puede ser nulo y está indexado.
+      -product_id: Es el identificador del producto vendido, es de tipo int y está indexado.
+      -supplier_id: Es el identificador del proveedor del producto, es de tipo int y está
+       indexado.
+      -product_name: Es el nombre del producto en el momento de la venta, es de tipo str y no
+       puede ser nulo.
+      -supplier_name: Es el nombre del proveedor en el momento de la venta, es de tipo str y no
+       puede ser nulo.
       -quantity: Es la cantidad de productos vendidos, es de tipo int y no puede ser nulo.
       -selling_price: Es el precio de venta del producto, es de tipo float y no puede ser nulo.
       -total_price: Es el precio total de la venta, es de tipo float y no puede ser nulo.
@@ -115,7 +187,9 @@ class Sale(db.Model):
 
 
     id = db.Column(db.Integer, primary_key=True)
-    sale_date = db.Column(db.Date, nullable=False)
+    sale_date = db.Column(db.Date, nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), index=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), index=True)
     product_name = db.Column(db.String(50), nullable=False)
     supplier_name = db.Column(db.String(50), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
@@ -129,15 +203,1582 @@ class Sale(db.Model):
         return f'<Sale {self.id}>'
 
 
+class SupplierStats(db.Model):
+    """ Clase SupplierStats.
+    Hace referencia a la tabla de agregados de ventas por proveedor. Se actualiza en la misma
+    transacción que cada venta, de forma que los gráficos leen una sola fila por proveedor
+    en lugar de recorrer todas las ventas.
+    args:
+      -supplier_id: Es el identificador del proveedor, es de tipo int y es la clave primaria.
+      -units_sold: Es el total de unidades vendidas, es de tipo int y no puede ser nulo.
+      -revenue: Es el total facturado, es de tipo float y no puede ser nulo.
+      -cost: Es el coste total de lo vendido, es de tipo float y no puede ser nulo.
+      -profit: Es el beneficio total, es de tipo float y no puede ser nulo.
+      -sale_count: Es el número de ventas registradas, es de tipo int y no puede ser nulo."""
+
+
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), primary_key=True)
+    units_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0)
+    profit = db.Column(db.Float, nullable=False, default=0)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+
+    """ El método __repr__ nos aporta una representación legible en cadena del objeto. """
+    def __repr__(self):
+        return f'<SupplierStats {self.supplier_id}>'
+
+
+class SupplierSalesRollup(db.Model):
+    """ Clase SupplierSalesRollup.
+    Hace referencia a la tabla de ventas agregadas por proveedor y periodo (día o mes). Se
+    actualiza en la misma transacción que cada venta y permite filtrar los gráficos por
+    rango de fechas sin recorrer la tabla de ventas.
+    args:
+      -granularity: Es el tamaño del periodo ('day' o 'month'), es de tipo str y forma parte
+       de la clave primaria.
+      -period: Es el primer día del periodo, es de tipo date y forma parte de la clave primaria.
+      -supplier_id: Es el identificador del proveedor, es de tipo int y forma parte de la clave
+       primaria.
+      -units_sold, revenue, cost, profit, sale_count: Son los totales del periodo, igual que en
+       SupplierStats."""
+
+
+    granularity = db.Column(db.String(5), primary_key=True)
+    period = db.Column(db.Date, primary_key=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), primary_key=True)
+    units_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0)
+    profit = db.Column(db.Float, nullable=False, default=0)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+
+    """ El método __repr__ nos aporta una representación legible en cadena del objeto. """
+    def __repr__(self):
+        return f'<SupplierSalesRollup {self.granularity} {self.period} {self.supplier_id}>'
+
+
+class ProductSalesRollup(db.Model):
+    """ Clase ProductSalesRollup.
+    Hace referencia a la tabla de ventas agregadas por producto y periodo (día o mes).
+    args:
+      -granularity: Es el tamaño del periodo ('day' o 'month'), es de tipo str y forma parte
+       de la clave primaria.
+      -period: Es el primer día del periodo, es de tipo date y forma parte de la clave primaria.
+      -product_id: Es el identificador del producto, es de tipo int y forma parte de la clave
+       primaria.
+      -supplier_id: Es el identificador del proveedor del producto, es de tipo int.
+      -units_sold, revenue, cost, profit, sale_count: Son los totales del periodo, igual que en
+       SupplierStats."""
+
+
+    granularity = db.Column(db.String(5), primary_key=True)
+    period = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), nullable=False)
+    units_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0)
+    profit = db.Column(db.Float, nullable=False, default=0)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+
+    """ El método __repr__ nos aporta una representación legible en cadena del objeto. """
+    def __repr__(self):
+        return f'<ProductSalesRollup {self.granularity} {self.period} {self.product_id}>'
+
+
+class ReportJob(db.Model):
+    """ Clase ReportJob.
+    Hace referencia a la tabla de trabajos de informes. Cada fila es una ejecución de un
+    informe en segundo plano; las rutas leen el resultado del último trabajo terminado en
+    lugar de calcular el informe.
+    args:
+      -id: Es el identificador del trabajo, es de tipo int y es la clave primaria.
+      -name: Es el nombre del informe (una clave de REPORTS), es de tipo str y no puede ser nulo.
+      -status: Es el estado del trabajo ('pending', 'running', 'done' o 'failed'), es de tipo
+       str y no puede ser nulo.
+      -created_at: Es el momento (en UTC) en que se encoló el trabajo, es de tipo datetime.
+      -not_before: Es el momento (en UTC) a partir del cual puede empezar, es de tipo datetime.
+      -owner: Es el pid del proceso que lo tiene a su cargo: el que lo encoló mientras está
+       pendiente y el que lo calcula cuando está en marcha. Es de tipo int.
+      -started_at: Es el momento en que empezó a ejecutarse, es de tipo datetime.
+      -finished_at: Es el momento en que terminó, es de tipo datetime.
+      -result: Es el resultado del informe en JSON, es de tipo str.
+      -error: Es el mensaje de error si el trabajo falló, es de tipo str."""
+
+
+    __table_args__ = (db.Index('ix_report_job_name_status_finished_at', 'name', 'status', 'finished_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    created_at = db.Column(db.DateTime, nullable=False)
+    not_before = db.Column(db.DateTime)
+    owner = db.Column(db.Integer)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+
+    """ El método __repr__ nos aporta una representación legible en cadena del objeto. """
+    def __repr__(self):
+        return f'<ReportJob {self.id} {self.name} {self.status}>'
+
+
+class DataVersion(db.Model):
+    """ Clase DataVersion.
+    Hace referencia a la tabla de versión de los datos, que tiene una única fila. Las rutas
+    de escritura la incrementan en la misma transacción que sus cambios, así que todos los
+    procesos ven la misma versión y ninguno puede dar por válido un resultado calculado con
+    datos anteriores.
+    args:
+      -id: Es el identificador de la fila, siempre 1, es de tipo int y es la clave primaria.
+      -version: Es el número de cambios confirmados, es de tipo int y no puede ser nulo.
+      -modified_at: Es el momento (en UTC) del último cambio, es de tipo datetime y no puede
+       ser nulo."""
 
-"""  Aquí se crea la base de datos y las tablas correspondientes utilizando el
- contexto de la aplicación Flask. """
-with app.app_context():
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified_at = db.Column(db.DateTime, nullable=False)
+
+    """ El método __repr__ nos aporta una representación legible en cadena del objeto. """
+    def __repr__(self):
+        return f'<DataVersion {self.version}>'
+
+
+""" Capa de informes. Cada función resuelve los totales con una única consulta agrupada
+ (GROUP BY) sobre las claves foráneas indexadas de Sale, sin cargar objetos en Python. """
+
+def sales_by_supplier_query():
+    # Consulta agrupada con los totales de ventas por proveedor. Las columnas siguen el
+    # orden de SupplierStats para poder reutilizarla en un INSERT ... SELECT.
+    return (
+        db.select(
+            Sale.supplier_id,
+            func.sum(Sale.quantity),
+            func.sum(Sale.total_price),
+            func.sum(Sale.cost_price),
+            func.sum(Sale.total_profit),
+            func.count(Sale.id),
+        )
+        .group_by(Sale.supplier_id)
+    )
+
+
+def sales_by_supplier():
+    # Devuelve una lista de filas (supplier_id, unidades, facturación, coste, beneficio,
+    # número de ventas) con los totales de cada proveedor.
+    return db.session.execute(sales_by_supplier_query()).all()
+
+
+def sales_by_product(start=None, end=None, limit=None):
+    # Devuelve una lista de filas (product_id, nombre, unidades, facturación, beneficio)
+    # con los totales de cada producto, ordenadas de mayor a menor facturación y, si se
+    # indica limit, solo las limit primeras. Si se indica un rango de fechas, los totales
+    # salen de las tablas de agregados por periodo.
+    if start is not None or end is not None:
+        return db.session.execute(
+            db.select(
+                ProductSalesRollup.product_id,
+                Product.name,
+                func.sum(ProductSalesRollup.units_sold),
+                func.sum(ProductSalesRollup.revenue),
+                func.sum(ProductSalesRollup.profit),
+            )
+            .join(Product, Product.id == ProductSalesRollup.product_id)
+            .where(rollup_period_filter(ProductSalesRollup, start, end))
+            .group_by(ProductSalesRollup.product_id)
+            .order_by(func.sum(ProductSalesRollup.revenue).desc())
+            .limit(limit)
+        ).all()
+
+    return db.session.execute(
+        db.select(
+            Sale.product_id,
+            Product.name,
+            func.sum(Sale.quantity),
+            func.sum(Sale.total_price),
+            func.sum(Sale.total_profit),
+        )
+        .join(Product, Product.id == Sale.product_id)
+        .group_by(Sale.product_id)
+        .order_by(func.sum(Sale.total_price).desc())
+        .limit(limit)
+    ).all()
+
+
+""" Agregados por periodo. Cada venta se suma a su fila diaria y a su fila mensual, tanto
+ por proveedor como por producto. Un rango de fechas se resuelve con las filas mensuales
+ de los meses completos que contiene y las diarias de los días sueltos de los extremos. """
+
+ROLLUP_MEASURES = ('units_sold', 'revenue', 'cost', 'profit', 'sale_count')
+ROLLUP_MIN_DATE = date(1900, 1, 1)
+ROLLUP_MAX_DATE = date(9998, 12, 31)
+
+
+def next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def rollup_period_filter(model, start, end):
+    # Condición SQL que selecciona las filas diarias y mensuales que cubren exactamente el
+    # rango [start, end] sin solaparse.
+    start = start or ROLLUP_MIN_DATE
+    end = end or ROLLUP_MAX_DATE
+    first_full_month = start if start.day == 1 else next_month(start)
+    end_full_months = next_month(end) if next_month(end) - timedelta(days=1) == end else end.replace(day=1)
+
+    if first_full_month >= end_full_months:
+        return and_(model.granularity == 'day', model.period.between(start, end))
+
+    return or_(
+        and_(model.granularity == 'month', model.period >= first_full_month, model.period < end_full_months),
+        and_(model.granularity == 'day', model.period >= start, model.period < first_full_month),
+        and_(model.granularity == 'day', model.period >= end_full_months, model.period <= end),
+    )
+
+
+def upsert_rollup(model, rows):
+    # Suma las filas indicadas a la tabla de agregados con INSERT ... ON CONFLICT DO UPDATE
+    # en una sola sentencia executemany.
+    table = model.__table__
+    statement = sqlite_insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[column.name for column in table.primary_key.columns],
+        set_={measure: table.c[measure] + statement.excluded[measure] for measure in ROLLUP_MEASURES},
+    )
+    db.session.execute(statement, rows)
+
+
+def record_sale_rollups(sales):
+    # Suma una lista de ventas (diccionarios con sale_date, product_id, supplier_id,
+    # quantity, total_price, cost_price y total_profit) a los agregados diarios y mensuales.
+    # Las ventas se agrupan antes en Python para escribir una fila por clave. No hace commit.
+    supplier_rows = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0])
+    product_rows = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0])
+
+    for sale in sales:
+        measures = (sale['quantity'], sale['total_price'], sale['cost_price'], sale['total_profit'], 1)
+        for granularity, period in (('day', sale['sale_date']), ('month', sale['sale_date'].replace(day=1))):
+            for totals in (supplier_rows[(granularity, period, sale['supplier_id'])],
+                           product_rows[(granularity, period, sale['product_id'], sale['supplier_id'])]):
+                for index, value in enumerate(measures):
+                    totals[index] += value
+
+    if supplier_rows:
+        upsert_rollup(SupplierSalesRollup, [
+            {'granularity': granularity, 'period': period, 'supplier_id': supplier_id, **dict(zip(ROLLUP_MEASURES, totals))}
+            for (granularity, period, supplier_id), totals in supplier_rows.items()
+        ])
+        upsert_rollup(ProductSalesRollup, [
+            {'granularity': granularity, 'period': period, 'product_id': product_id, 'supplier_id': supplier_id,
+             **dict(zip(ROLLUP_MEASURES, totals))}
+            for (granularity, period, product_id, supplier_id), totals in product_rows.items()
+        ])
+
+
+def rebuild_sale_rollups():
+    # Recalcula desde cero los agregados diarios y mensuales a partir de la tabla de ventas
+    # con una consulta agrupada por cada tabla y granularidad.
+    db.session.execute(db.delete(SupplierSalesRollup))
+    db.session.execute(db.delete(ProductSalesRollup))
+
+    measures = (func.sum(Sale.quantity), func.sum(Sale.total_price), func.sum(Sale.cost_price),
+                func.sum(Sale.total_profit), func.count(Sale.id))
+    periods = (('day', Sale.sale_date), ('month', func.strftime('%Y-%m-01', Sale.sale_date)))
+
+    for granularity, period in periods:
+        db.session.execute(
+            db.insert(SupplierSalesRollup).from_select(
+                ['granularity', 'period', 'supplier_id', *ROLLUP_MEASURES],
+                db.select(db.literal(granularity), period, Sale.supplier_id, *measures)
+                .where(Sale.supplier_id.is_not(None))
+                .group_by(period, Sale.supplier_id)
+            )
+        )
+        db.session.execute(
+            db.insert(ProductSalesRollup).from_select(
+                ['granularity', 'period', 'product_id', 'supplier_id', *ROLLUP_MEASURES],
+                db.select(db.literal(granularity), period, Sale.product_id, Sale.supplier_id, *measures)
+                .where(Sale.product_id.is_not(None), Sale.supplier_id.is_not(None))
+                .group_by(period, Sale.product_id, Sale.supplier_id)
+            )
+        )
+    db.session.commit()
+
+
+def supplier_time_series(field, start, end, granularity):
+    # Devuelve los periodos del rango y, por proveedor, el valor de cada periodo ('sales'
+    # para unidades o 'profits' para beneficio), leyendo una fila por proveedor y periodo.
+    measure = SupplierSalesRollup.units_sold if field == 'sales' else SupplierSalesRollup.profit
+    start = start or ROLLUP_MIN_DATE
+    if granularity == 'month':
+        start = start.replace(day=1)
+
+    rows = db.session.execute(
+        db.select(SupplierSalesRollup.period, Supplier.company_name, measure)
+        .join(Supplier, Supplier.id == SupplierSalesRollup.supplier_id)
+        .where(SupplierSalesRollup.granularity == granularity,
+               SupplierSalesRollup.period.between(start, end or ROLLUP_MAX_DATE))
+        .order_by(SupplierSalesRollup.period, Supplier.id)
+    ).all()
+
+    labels = sorted({row[0] for row in rows})
+    positions = {period: index for index, period in enumerate(labels)}
+    series = {}
+    for period, name, value in rows:
+        values = series.setdefault(name, [0] * len(labels))
+        values[positions[period]] = value
+
+    return {
+        'labels': [period.isoformat() for period in labels],
+        'series': [{'name': name, 'values': values} for name, values in series.items()],
+    }
+
+
+""" Control de bajo stock. En lugar de evaluar stock <= 0.9 * quantity sobre toda la tabla,
+ cada producto guarda en la columna indexada stock_shortfall cuánto le falta para llegar a
+ su umbral. Las consultas de bajo stock recorren ese índice de mayor a menor déficit. """
+
+def stock_shortfall_expression(stock):
+    # Expresión SQL del déficit de un producto para el stock indicado. El umbral es el del
+    # producto, si no el de su proveedor y si no el global LOW_STOCK_THRESHOLD.
+    supplier_threshold = (
+        db.select(Supplier.low_stock_threshold)
+        .where(Supplier.id == Product.supplier_id)
+        .scalar_subquery()
+    )
+    threshold = func.coalesce(Product.low_stock_threshold, supplier_threshold, current_app.config['LOW_STOCK_THRESHOLD'])
+    return (threshold * Product.quantity - stock) / func.max(Product.quantity, 1)
+
+
+def refresh_stock_shortfall(*criteria):
+    # Recalcula el déficit de los productos que cumplen los criterios (todos si no se indica
+    # ninguno). No hace commit.
+    db.session.execute(
+        db.update(Product).where(*criteria).values(stock_shortfall=stock_shortfall_expression(Product.stock)),
+        execution_options={'synchronize_session': False}
+    )
+
+
+def low_stock_query():
+    return Product.query.filter(Product.stock_shortfall >= 0)
+
+
+""" Búsqueda de productos. La tabla virtual FTS5 product_fts indexa el nombre y la
+ descripción de cada producto usando la propia tabla product como contenido, así que solo
+ guarda el índice. Unos triggers la mantienen al día en cada INSERT, DELETE y UPDATE del
+ nombre o la descripción, ya sea desde el ORM, desde la ingesta por lotes o desde SQL
+ directo; los cambios de stock no la tocan. Los índices de prefijo de 2 y 3 caracteres
+ aceleran la búsqueda mientras se escribe. """
+
+PRODUCT_SEARCH_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+    "name, description, content='product', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN "
+    "INSERT INTO product_fts (rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN "
+    "INSERT INTO product_fts (product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE OF name, description ON product BEGIN "
+    "INSERT INTO product_fts (product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO product_fts (rowid, name, description) VALUES (new.id, new.name, new.description); END",
+)
+
+
+def create_product_search_index(connection):
+    # Crea la tabla de búsqueda y sus triggers si no existen. Si la tabla es nueva la rellena
+    # con los productos que ya hay.
+    exists = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_fts'").first()
+    for statement in PRODUCT_SEARCH_SCHEMA:
+        connection.exec_driver_sql(statement)
+    if not exists:
+        connection.exec_driver_sql("INSERT INTO product_fts (product_fts) VALUES ('rebuild')")
+
+
+def search_words(text):
+    # Palabras del texto en minúsculas y sin tildes, igual que las separa el tokenizador
+    normalized = unicodedata.normalize('NFKD', text.lower())
+    return re.findall(r'\w+', ''.join(char for char in normalized if not unicodedata.combining(char)))
+
+
+def product_search_expression(words):
+    # Convierte las palabras escritas por el usuario en una consulta FTS5 en la que deben
+    # aparecer todas. Solo la última, que es la que se está escribiendo, se busca como
+    # prefijo; las anteriores se buscan enteras, que es mucho más barato. Van entre comillas
+    # para que los operadores de FTS5 (AND, OR, NEAR, *, ...) se traten como texto.
+    return ' '.join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+
+def product_search_score(words, name, description):
+    # Relevancia de un resultado: cada palabra buscada que empieza una palabra del nombre
+    # vale 10 y cada una que empieza una palabra de la descripción vale 1.
+    name_words = search_words(name or '')
+    description_words = search_words(description or '')
+    return sum(10 * any(word.startswith(term) for word in name_words) +
+               any(word.startswith(term) for word in description_words)
+               for term in words)
+
+
+def search_candidates(expression, limit):
+    # Lee como mucho limit productos que cumplen la expresión de FTS5, con el nombre de su
+    # proveedor. El LIMIT va dentro de la subconsulta sobre el índice, que devuelve las
+    # filas en su propio orden, así que SQLite para en cuanto tiene limit coincidencias en
+    # lugar de leerlas todas para ordenarlas.
+    return db.session.execute(
+        db.text(
+            'SELECT product.id, product.name, product.description, product.stock, product.precio_venta, supplier.company_name '
+            'FROM (SELECT rowid AS id FROM product_fts WHERE product_fts MATCH :expression LIMIT :candidates) AS matches '
+            'JOIN product ON product.id = matches.id '
+            'LEFT JOIN supplier ON supplier.id = product.supplier_id'
+        ),
+        {'expression': expression, 'candidates': limit}
+    ).all()
+
+
+def search_products(text, limit):
+    # Devuelve los productos que coinciden con el texto, de más a menos relevantes y, a
+    # igual relevancia, los de nombre más corto primero, junto con el nombre de su proveedor.
+    # La búsqueda se hace en dos pasos. Primero se buscan, con un filtro de columna de FTS5,
+    # los productos que tienen todas las palabras en el nombre, que siempre puntúan más que
+    # el resto. Solo si no llegan a limit se completan con coincidencias en cualquier
+    # columna. En los dos pasos se leen como mucho PRODUCT_SEARCH_CANDIDATES en el orden del
+    # índice (ver search_candidates), sin ordenar todas las coincidencias en SQL, y el
+    # conjunto acotado se ordena aquí.
+    words = search_words(text)
+    if not words:
+        return []
+
+    expression = product_search_expression(words)
+    candidates_limit = current_app.config['PRODUCT_SEARCH_CANDIDATES']
+
+    candidates = search_candidates(f'name : ({expression})', candidates_limit)
+
+    if len(candidates) < limit:
+        found = {row.id for row in candidates}
+        candidates += [row for row in search_candidates(expression, candidates_limit + len(found))
+                       if row.id not in found]
+
+    candidates.sort(key=lambda row: (-product_search_score(words, row.name, row.description), len(row.name), row.id))
+    return [(row.id, row.name, row.stock, row.precio_venta, row.company_name) for row in candidates[:limit]]
+
+
+""" Descuento de stock. La comprobación de stock y la resta se hacen en una sola sentencia
+ UPDATE condicional, de forma que dos ventas simultáneas nunca pueden dejar el stock en
+ negativo ni perder una actualización. """
+
+def decrement_stock(product_id, quantity):
+    # Resta la cantidad al stock del producto solo si hay suficiente y devuelve los datos del
+    # producto necesarios para registrar la venta, o None si no existe o no hay stock.
+    # No hace commit: la venta debe insertarse en la misma transacción.
+    return db.session.execute(
+        db.update(Product)
+        .where(Product.id == product_id, Product.stock >= quantity)
+        .values(stock=Product.stock - quantity,
+                stock_shortfall=stock_shortfall_expression(Product.stock - quantity))
+        .returning(Product.name, Product.supplier_id, Product.precio_venta, Product.precio_costo)
+    ).first()
+
+
+""" Ingesta de ventas por lotes. Primero se lee todo el cuerpo en streaming y se valida el
+ formato de cada línea sin tocar la base de datos; las líneas válidas se guardan en un
+ fichero temporal, así que una subida lenta no bloquea las demás escrituras y la memoria no
+ depende del tamaño del lote. Después se escribe el lote entero en una única transacción:
+ por bloques de líneas se lee el stock de sus productos con una consulta, se insertan las
+ ventas aceptadas con executemany y se descuenta el stock con una actualización agrupada
+ por producto. Si algo falla no se confirma ninguna venta del lote, de modo que el
+ terminal puede reenviarlo entero sin duplicar ventas. """
+
+def lock_for_write():
+    # Abre la transacción de escritura con una sentencia UPDATE que no modifica nada. Así
+    # SQLite reserva la base de datos antes de leer el stock y ninguna otra escritura puede
+    # cambiarlo hasta el commit.
+    db.session.execute(db.update(Product).where(db.false()).values(stock=Product.stock))
+
+
+def read_sale_lines():
+    # Genera tuplas (número de línea, datos) a partir del cuerpo de la petición. Acepta CSV
+    # (text/csv, con cabecera product,quantity[,sale_date]), JSON por líneas
+    # (application/x-ndjson) o un array JSON (application/json). CSV y NDJSON se leen en
+    # streaming sin cargar el cuerpo entero en memoria.
+    mimetype = request.mimetype
+    if mimetype == 'text/csv':
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+        for number, row in enumerate(csv.DictReader(stream), start=1):
+            yield number, row
+    elif mimetype == 'application/x-ndjson':
+        number = 0
+        for line in request.stream:
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                yield number, None
+    else:
+        payload = request.get_json(silent=True)
+        if isinstance(payload, dict):
+            payload = payload.get('sales')
+        if not isinstance(payload, list):
+            abort(400)
+        for number, row in enumerate(payload, start=1):
+            yield number, row
+
+
+def parse_sale_line(number, row):
+    # Convierte una línea en la tupla (número, product_id, quantity, sale_date, error); si la
+    # línea no es válida, error contiene el motivo y el resto de campos son None.
+    try:
+        product_id = int(row.get('product', row.get('product_id')))
+        quantity = int(row['quantity'])
+        sale_date = date.fromisoformat(row['sale_date']) if row.get('sale_date') else date.today()
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return number, None, None, None, 'Invalid line'
+
+    if quantity <= 0:
+        return number, None, None, None, 'Invalid quantity'
+    return number, product_id, quantity, sale_date, None
+
+
+def process_sales_chunk(chunk, errors):
+    # Valida un bloque de líneas contra el stock, inserta las ventas aceptadas y descuenta
+    # el stock. Añade a errors las líneas rechazadas y devuelve el número de aceptadas.
+    product_ids = {line[1] for line in chunk if line[1] is not None}
+    products = {
+        row.id: row for row in db.session.execute(
+            db.select(Product.id, Product.name, Product.supplier_id, Product.precio_venta, Product.precio_costo,
+                      Product.stock, Supplier.company_name)
+            .join(Supplier, Supplier.id == Product.supplier_id)
+            .where(Product.id.in_(product_ids))
+        )
+    }
+    remaining = {product_id: row.stock for product_id, row in products.items()}
+
+    sales = []
+    sold = defaultdict(int)
+    supplier_totals = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0])
+
+    for number, product_id, quantity, sale_date, error in chunk:
+        if error is None and product_id not in products:
+            error = 'Invalid product'
+        if error is None and quantity > remaining[product_id]:
+            error = 'Insufficient stock'
+        if error is not None:
+            errors.append({'line': number, 'error': error})
+            continue
+
+        product = products[product_id]
+        remaining[product_id] -= quantity
+        sold[product_id] += quantity
+
+        total_price = product.precio_venta * quantity
+        cost_price = product.precio_costo * quantity
+        total_profit = total_price - cost_price
+        sales.append({
+            'sale_date': sale_date, 'product_id': product_id, 'supplier_id': product.supplier_id,
+            'product_name': product.name, 'supplier_name': product.company_name, 'quantity': quantity,
+            'selling_price': product.precio_venta, 'total_price': total_price,
+            'cost_price': cost_price, 'total_profit': total_profit,
+        })
+
+        totals = supplier_totals[product.supplier_id]
+        totals[0] += quantity
+        totals[1] += total_price
+        totals[2] += cost_price
+        totals[3] += total_profit
+        totals[4] += 1
+
+    if sales:
+        db.session.execute(db.insert(Sale), sales)
+
+        product_table = Product.__table__
+        db.session.execute(
+            product_table.update()
+            .where(product_table.c.id == db.bindparam('product_id'))
+            .values(stock=product_table.c.stock - db.bindparam('sold'),
+                    stock_shortfall=stock_shortfall_expression(product_table.c.stock - db.bindparam('sold'))),
+            [{'product_id': product_id, 'sold': quantity} for product_id, quantity in sold.items()]
+        )
+
+        for supplier_id, totals in supplier_totals.items():
+            record_supplier_sale(supplier_id, *totals)
+
+        record_sale_rollups(sales)
+
+    return len(sales)
+
+
+def spool_sale_lines(lines, errors):
+    # Valida el formato de todas las líneas y guarda las válidas en un fichero temporal como
+    # CSV (número, product_id, quantity, sale_date). Añade a errors las líneas rechazadas y
+    # devuelve el fichero listo para leerlo desde el principio.
+    spool = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+    writer = csv.writer(spool)
+    for number, row in lines:
+        number, product_id, quantity, sale_date, error = parse_sale_line(number, row)
+        if error is not None:
+            errors.append({'line': number, 'error': error})
+        else:
+            writer.writerow((number, product_id, quantity, sale_date.isoformat()))
+    spool.seek(0)
+    return spool
+
+
+def spooled_sales_chunks(spool, chunk_size):
+    # Lee las líneas guardadas por spool_sale_lines en bloques de como mucho chunk_size
+    # tuplas con el mismo formato que parse_sale_line.
+    chunk = []
+    for number, product_id, quantity, sale_date in csv.reader(spool):
+        chunk.append((int(number), int(product_id), int(quantity), date.fromisoformat(sale_date), None))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ingest_sales(lines, chunk_size):
+    # Lee y valida todo el lote y después lo escribe por bloques en una única transacción
+    # de escritura. Devuelve el número de ventas aceptadas y la lista de líneas rechazadas,
+    # ordenada por número de línea. No confirma nada si falla cualquier bloque.
+    errors = []
+    accepted = 0
+    with spool_sale_lines(lines, errors) as spool:
+        lock_for_write()
+        for chunk in spooled_sales_chunks(spool, chunk_size):
+            accepted += process_sales_chunk(chunk, errors)
+        if accepted:
+            bump_data_version()
+        db.session.commit()
+
+    errors.sort(key=lambda error: error['line'])
+    return accepted, errors
+
+
+""" Funciones auxiliares para mantener los agregados por proveedor. """
+
+def record_supplier_sale(supplier_id, quantity, revenue, cost, profit, sale_count=1):
+    # Suma una o varias ventas a los agregados del proveedor dentro de la transacción actual.
+    # El incremento se hace en SQL para no perder actualizaciones concurrentes; si el
+    # proveedor aún no tiene fila de agregados, se crea. No hace commit.
+    updated = db.session.execute(
+        db.update(SupplierStats)
+        .where(SupplierStats.supplier_id == supplier_id)
+        .values(
+            units_sold=SupplierStats.units_sold + quantity,
+            revenue=SupplierStats.revenue + revenue,
+            cost=SupplierStats.cost + cost,
+            profit=SupplierStats.profit + profit,
+            sale_count=SupplierStats.sale_count + sale_count,
+        )
+    ).rowcount
+
+    if not updated:
+        db.session.add(SupplierStats(supplier_id=supplier_id, units_sold=quantity, revenue=revenue,
+                                     cost=cost, profit=profit, sale_count=sale_count))
+
+
+def rebuild_supplier_stats():
+    # Recalcula desde cero los agregados de todos los proveedores a partir de la tabla de
+    # ventas con una única consulta agrupada. Sirve para poblar la tabla con datos existentes
+    # o para corregirla si se ha desincronizado.
+    db.session.execute(db.delete(SupplierStats))
+    db.session.execute(
+        db.insert(SupplierStats).from_select(
+            ['supplier_id', 'units_sold', 'revenue', 'cost', 'profit', 'sale_count'],
+            sales_by_supplier_query().where(Sale.supplier_id.is_not(None))
+        )
+    )
+    db.session.commit()
+
+
+def supplier_totals(start=None, end=None):
+    # Devuelve los nombres de los proveedores junto con sus unidades vendidas y beneficios,
+    # leyendo una fila de agregados por proveedor. Si se indica un rango de fechas, los
+    # totales salen de los agregados diarios y mensuales de ese rango.
+    if start is None and end is None:
+        totals = SupplierStats
+        units_sold, profit, supplier_id = SupplierStats.units_sold, SupplierStats.profit, SupplierStats.supplier_id
+    else:
+        totals = (
+            db.select(
+                SupplierSalesRollup.supplier_id,
+                func.sum(SupplierSalesRollup.units_sold).label('units_sold'),
+                func.sum(SupplierSalesRollup.profit).label('profit'),
+            )
+            .where(rollup_period_filter(SupplierSalesRollup, start, end))
+            .group_by(SupplierSalesRollup.supplier_id)
+            .subquery()
+        )
+        units_sold, profit, supplier_id = totals.c.units_sold, totals.c.profit, totals.c.supplier_id
+
+    rows = db.session.execute(
+        db.select(
+            Supplier.company_name,
+            func.coalesce(units_sold, 0),
+            func.coalesce(profit, 0),
+        )
+        .outerjoin(totals, supplier_id == Supplier.id)
+        .order_by(Supplier.id)
+    ).all()
+
+    names = [row[0] for row in rows]
+    sales_data = [row[1] for row in rows]
+    profits_data = [row[2] for row in rows]
+    return names, sales_data, profits_data
+
+
+""" Migración del esquema. db.create_all() solo crea las tablas que no existen, así que las
+ columnas e índices añadidos a tablas ya creadas se aplican aquí. Es idempotente. """
+
+def upgrade_schema():
+    # Añade a la tabla de ventas las claves foráneas product_id y supplier_id si faltan y
+    # las rellena a partir de los nombres guardados en cada venta. Añade también las columnas
+    # de bajo stock y calcula el déficit de los productos existentes. Después crea los índices
+    # y la tabla de búsqueda de productos.
+    inspector = db.inspect(db.engine)
+    sale_columns = {column['name'] for column in inspector.get_columns('sale')}
+    product_columns = {column['name'] for column in inspector.get_columns('product')}
+    supplier_columns = {column['name'] for column in inspector.get_columns('supplier')}
+    report_job_columns = {column['name'] for column in inspector.get_columns('report_job')}
+
+    with db.engine.begin() as connection:
+        if 'supplier_id' not in sale_columns:
+            connection.exec_driver_sql('ALTER TABLE sale ADD COLUMN supplier_id INTEGER REFERENCES supplier (id)')
+            connection.exec_driver_sql(
+                'UPDATE sale SET supplier_id = ('
+                'SELECT supplier.id FROM supplier WHERE supplier.company_name = sale.supplier_name '
+                'ORDER BY supplier.id LIMIT 1)'
+            )
+
+        if 'product_id' not in sale_columns:
+            connection.exec_driver_sql('ALTER TABLE sale ADD COLUMN product_id INTEGER REFERENCES product (id)')
+            connection.exec_driver_sql(
+                'UPDATE sale SET product_id = ('
+                'SELECT product.id FROM product WHERE product.name = sale.product_name '
+                'AND product.supplier_id = sale.supplier_id ORDER BY product.id LIMIT 1)'
+            )
+
+        if 'low_stock_threshold' not in supplier_columns:
+            connection.exec_driver_sql('ALTER TABLE supplier ADD COLUMN low_stock_threshold FLOAT')
+
+        if 'low_stock_threshold' not in product_columns:
+            connection.exec_driver_sql('ALTER TABLE product ADD COLUMN low_stock_threshold FLOAT')
+
+        if 'not_before' not in report_job_columns:
+            connection.exec_driver_sql('ALTER TABLE report_job ADD COLUMN not_before DATETIME')
+
+        if 'owner' not in report_job_columns:
+            connection.exec_driver_sql('ALTER TABLE report_job ADD COLUMN owner INTEGER')
+
+        if 'stock_shortfall' not in product_columns:
+            connection.exec_driver_sql('ALTER TABLE product ADD COLUMN stock_shortfall FLOAT')
+            connection.execute(db.update(Product).values(stock_shortfall=stock_shortfall_expression(Product.stock)))
+
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_sale_sale_date ON sale (sale_date)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_sale_product_id ON sale (product_id)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_sale_supplier_id ON sale (supplier_id)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_product_name ON product (name)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_supplier_company_name ON supplier (company_name)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_product_stock_shortfall ON product (stock_shortfall)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_product_precio_costo_id ON product (precio_costo, id)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_product_precio_venta_id ON product (precio_venta, id)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_product_stock_id ON product (stock, id)')
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_product_quantity_id ON product (quantity, id)')
+        connection.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_username ON user (username)')
+        create_product_search_index(connection)
+
+
+""" Inicialización de la base de datos. Crea las tablas que falten, aplica la migración del
+ esquema y, si las tablas de agregados están vacías pero ya hay ventas registradas, las
+ reconstruye a partir de ellas. No se ejecuta al importar la aplicación sino con el comando
+ de consola: flask --app main migrate """
+
+def init_database():
     db.create_all()
+    upgrade_schema()
+    db.session.execute(
+        sqlite_insert(DataVersion).values(id=1, version=0, modified_at=datetime.utcnow().replace(microsecond=0))
+        .on_conflict_do_nothing()
+    )
+    db.session.commit()
+    if db.session.query(SupplierStats.supplier_id).first() is None and db.session.query(Sale.id).first() is not None:
+        rebuild_supplier_stats()
+    if db.session.query(SupplierSalesRollup.supplier_id).first() is None and db.session.query(Sale.id).first() is not None:
+        rebuild_sale_rollups()
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    init_database()
+    print('Database migrated')
+
+
+""" Versión de los datos. Es la fila de la tabla data_version, que las rutas de escritura
+ (add_sale, add_product, add_supplier y la ingesta por lotes) incrementan en la misma
+ transacción que sus cambios; cualquier resultado calculado a partir de los datos puede
+ usarla como clave para saber si sigue siendo válido, en este proceso o en cualquier otro. """
+
+DATA_VERSION_EPOCH = datetime(1970, 1, 1)
+
+
+def current_data_version():
+    # Devuelve la versión actual de los datos y el momento (en UTC) de su último cambio
+    row = db.session.execute(
+        db.select(DataVersion.version, DataVersion.modified_at).where(DataVersion.id == 1)
+    ).first()
+    return tuple(row) if row is not None else (0, DATA_VERSION_EPOCH)
+
+
+def bump_data_version():
+    # Incrementa la versión dentro de la transacción actual; se aplica con su commit. No hace
+    # commit.
+    now = datetime.utcnow().replace(microsecond=0)
+    statement = sqlite_insert(DataVersion).values(id=1, version=1, modified_at=now)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['id'], set_={'version': DataVersion.version + 1, 'modified_at': now}))
+    db.session.info['data_changed'] = True
+
+
+@event.listens_for(SASession, 'after_commit')
+def data_changed(session):
+    # Tras confirmar un cambio de versión, avisa al hilo de informes del proceso para que
+    # encole los informes con los datos nuevos. Solo activa un evento: no toca la base de
+    # datos ni puede fallar después de que la escritura se haya confirmado. Con
+    # REPORT_ON_DATA_CHANGE a False los informes solo se recalculan con refresh-reports.
+    if (session.info.pop('data_changed', False) and has_app_context() and 'report_runner' in current_app.extensions
+            and current_app.config['REPORT_ON_DATA_CHANGE']):
+        report_runner().notify()
+
+
+@event.listens_for(SASession, 'after_rollback')
+def data_change_discarded(session):
+    session.info.pop('data_changed', None)
+
+
+class ChartCache:
+    """ Clase ChartCache.
+    Caché LRU acotada para los datos de los gráficos: la figura de Plotly en JSON y los datos
+    de la API de gráficos. Las entradas se indexan con la versión de los datos de la tabla
+    data_version, así que un cambio en los datos hecho en cualquier proceso deja obsoletas
+    las anteriores, que acaban saliendo por el extremo menos usado.
+    args:
+      -maxsize: Es el número máximo de entradas que se guardan, es de tipo int."""
+
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, name, render):
+        # Devuelve lo guardado para el gráfico y la versión actual de los datos o lo genera
+        # llamando a render() y lo guarda, expulsando la entrada menos usada.
+        key = (name, current_data_version()[0])
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        value = render()
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+def chart_cache():
+    # Devuelve la caché de gráficos de la aplicación actual
+    return current_app.extensions['chart_cache']
+
+
+""" Usuario autenticado. Es lo único que las rutas necesitan saber del usuario de la sesión:
+ su id, su nombre y si es administrador. """
+AuthenticatedUser = namedtuple('AuthenticatedUser', ['id', 'username', 'is_admin'])
+
+
+class UserCache:
+    """ Clase UserCache.
+    Caché LRU con caducidad de los usuarios autenticados, propia de cada proceso, para que
+    las rutas protegidas no consulten la tabla de usuarios en cada petición. Los cambios
+    hechos con el ORM sobre un usuario lo invalidan al momento en el proceso que los hace;
+    en los demás procesos la entrada caduca como mucho a los ttl segundos.
+    args:
+      -maxsize: Es el número máximo de usuarios que se guardan, es de tipo int.
+      -ttl: Es el tiempo en segundos que una entrada es válida, es de tipo float."""
+
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        # Devuelve el usuario guardado si no ha caducado o lo carga de la base de datos. Si el
+        # usuario ya no existe devuelve None.
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        row = db.session.query(User.id, User.username, User.is_admin).filter(User.id == user_id).first()
+        if row is None:
+            self.invalidate(user_id)
+            return None
+        return self.put(AuthenticatedUser(*row))
+
+    def put(self, user):
+        with self._lock:
+            self._entries[user.id] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+def user_cache():
+    # Devuelve la caché de usuarios de la aplicación actual
+    return current_app.extensions['user_cache']
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    # Cualquier cambio en un usuario hecho con el ORM saca su entrada de la caché
+    if has_app_context() and 'user_cache' in current_app.extensions:
+        user_cache().invalidate(target.id)
+
+
+def current_user():
+    # Devuelve el usuario de la sesión (de la caché si es posible) o None si no hay sesión o
+    # el usuario ya no existe, en cuyo caso también se cierra la sesión.
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    user = user_cache().get(user_id)
+    if user is None:
+        session.pop('user_id', None)
+    return user
+
+
+""" Informes en segundo plano. Los informes de REPORTS se calculan en un pool de procesos
+ cuando cambian los datos (ver data_changed y ReportRunner.notify), como mucho una vez por
+ intervalo, o con el comando de consola "flask --app main refresh-reports", pensado para
+ ejecutarse periódicamente con cron. Cada ejecución queda en la tabla report_job y las rutas leen el
+ último resultado terminado, así que una petición nunca espera a que se calcule un
+ agregado pesado. """
+
+def supplier_totals_report():
+    # Unidades vendidas y beneficio de cada proveedor, los datos del gráfico de /charts
+    names, sales_data, profits_data = supplier_totals()
+    return {'labels': names, 'sales': sales_data, 'profits': profits_data}
+
+
+def top_products_report():
+    # Los REPORT_TOP_PRODUCTS productos con más facturación
+    rows = sales_by_product(limit=current_app.config['REPORT_TOP_PRODUCTS'])
+    return {'products': [
+        {'id': product_id, 'name': name, 'units_sold': units_sold, 'revenue': revenue, 'profit': profit}
+        for product_id, name, units_sold, revenue, profit in rows
+    ]}
+
+
+def supplier_margin_report():
+    # Facturación, coste, beneficio y margen (beneficio / facturación) de cada proveedor
+    rows = db.session.execute(
+        db.select(
+            Supplier.id,
+            Supplier.company_name,
+            func.coalesce(SupplierStats.revenue, 0),
+            func.coalesce(SupplierStats.cost, 0),
+            func.coalesce(SupplierStats.profit, 0),
+        )
+        .outerjoin(SupplierStats, SupplierStats.supplier_id == Supplier.id)
+        .order_by(Supplier.id)
+    ).all()
+    return {'suppliers': [
+        {'id': supplier_id, 'name': name, 'revenue': revenue, 'cost': cost, 'profit': profit,
+         'margin': profit / revenue if revenue else None}
+        for supplier_id, name, revenue, cost, profit in rows
+    ]}
+
+
+def driver_batches(statement, params, batch_size):
+    # Ejecuta statement con el cursor de sqlite3 de la conexión de la sesión y devuelve sus
+    # filas en listas de tuplas de como mucho batch_size filas. Las lecturas masivas que van
+    # directas a NumPy no necesitan un Row de SQLAlchemy por fila, que es lo que más cuesta
+    # con millones de filas.
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.execute(statement, params)
+        while rows := cursor.fetchmany(batch_size):
+            yield rows
+    finally:
+        cursor.close()
+
+
+def restock_forecast_report():
+    # Previsión de reposición de todos los productos (ver forecast.py). El historial sale de
+    # los agregados diarios por producto de los últimos FORECAST_WINDOW_DAYS días y se lee
+    # por bloques de FORECAST_BATCH_SIZE filas con driver_batches. Devuelve por proveedor cuántos productos hay
+    # que pedir, cuántas unidades y su coste, y los FORECAST_MAX_PRODUCTS productos a pedir
+    # con menos días de stock.
+    # NumPy se importa aquí y no al cargar el módulo: solo lo necesita este informe
+    import numpy as np
+    from forecast import RestockForecast
+
+    config = current_app.config
+    window_days = config['FORECAST_WINDOW_DAYS']
+    batch_size = config['FORECAST_BATCH_SIZE']
+    today = date.today()
+
+    blocks = [np.array(rows, dtype=np.float64) for rows in driver_batches(
+        'SELECT id, supplier_id, stock, precio_costo FROM product ORDER BY id', (), batch_size)]
+    product_ids, supplier_ids, stock, cost = (np.concatenate(blocks) if blocks else np.empty((0, 4))).T
+    product_ids = product_ids.astype(np.int64)
+
+    forecast = RestockForecast(product_ids, stock, window_days, config['FORECAST_HALF_LIFE_DAYS'])
+    sales = driver_batches(
+        "SELECT product_id, julianday(:today) - julianday(period), units_sold FROM product_sales_rollup "
+        "WHERE granularity = 'day' AND period > :since AND period <= :today",
+        {'today': today.isoformat(), 'since': (today - timedelta(days=window_days)).isoformat()}, batch_size)
+    for rows in sales:
+        block = np.array(rows, dtype=np.float64)
+        forecast.add_sales(block[:, 0], block[:, 1], block[:, 2])
+
+    velocity, days_remaining, reorder_quantity = forecast.result(
+        config['FORECAST_LEAD_TIME_DAYS'], config['FORECAST_COVER_DAYS'], config['FORECAST_SERVICE_Z'])
+
+    suppliers = db.session.execute(db.select(Supplier.id, Supplier.company_name).order_by(Supplier.id)).all()
+    supplier_index = np.searchsorted(np.array([row[0] for row in suppliers], dtype=np.int64), supplier_ids.astype(np.int64))
+    supplier_products = np.bincount(supplier_index, weights=reorder_quantity > 0, minlength=len(suppliers))
+    supplier_units = np.bincount(supplier_index, weights=reorder_quantity, minlength=len(suppliers))
+    supplier_cost = np.bincount(supplier_index, weights=reorder_quantity * cost, minlength=len(suppliers))
+
+    urgent = np.flatnonzero(reorder_quantity > 0)
+    urgent = urgent[np.argsort(days_remaining[urgent], kind='stable')][:config['FORECAST_MAX_PRODUCTS']]
+    names = dict(db.session.execute(
+        db.select(Product.id, Product.name).where(Product.id.in_(product_ids[urgent].tolist()))
+    ).all())
+
+    return {
+        'date': today.isoformat(),
+        'window_days': window_days,
+        'suppliers': [
+            {'id': supplier_id, 'name': name, 'products': int(supplier_products[index]),
+             'units': int(supplier_units[index]), 'cost': float(supplier_cost[index])}
+            for index, (supplier_id, name) in enumerate(suppliers)
+        ],
+        'products': [
+            {'id': int(product_ids[index]), 'name': names.get(int(product_ids[index])),
+             'supplier_id': int(supplier_ids[index]), 'stock': int(stock[index]),
+             'velocity': float(velocity[index]),
+             'days_remaining': float(days_remaining[index]) if np.isfinite(days_remaining[index]) else None,
+             'reorder_quantity': int(reorder_quantity[index])}
+            for index in urgent
+        ],
+    }
+
+
+REPORTS = {
+    'supplier_totals': supplier_totals_report,
+    'top_products': top_products_report,
+    'supplier_margin': supplier_margin_report,
+    'restock_forecast': restock_forecast_report,
+}
+
+
+class ReportRunner:
+    """ Clase ReportRunner.
+    Encola y ejecuta los informes de REPORTS. La coordinación entre procesos se hace con la
+    tabla report_job, que comparten todos los workers:
+      -Cada informe tiene como mucho un trabajo pendiente. Un cambio en los datos que llega
+       cuando ya hay uno pendiente se une a él, y un trabajo nuevo no empieza antes de que
+       pasen REPORT_MIN_INTERVALS[nombre] segundos desde el anterior, así que una carga
+       continua de escrituras recalcula cada informe como mucho una vez por intervalo.
+      -Un trabajo pendiente solo pasa a 'running' si no hay otro del mismo informe en marcha
+       y hay menos de max_workers en marcha en total. Ese paso es un único UPDATE
+       condicional, así que solo un proceso calcula cada informe y el límite es global.
+      -Los trabajos se calculan en un pool de procesos aparte, de forma que un informe
+       pesado no compite por el GIL con las peticiones del worker web.
+      -Los trabajos pendientes o en marcha cuyo proceso ya no existe, o que llevan más de
+       timeout segundos, se marcan como fallidos.
+    args:
+      -app: Es la aplicación Flask cuyos trabajos se ejecutan.
+      -max_workers: Es el número máximo de informes que se calculan a la vez, es de tipo int.
+      -min_intervals: Es el intervalo mínimo en segundos entre dos trabajos de cada informe,
+       es de tipo dict.
+      -timeout: Es el tiempo máximo en segundos de un trabajo, es de tipo float.
+      -retry: Es el tiempo en segundos tras el que se reintenta empezar un trabajo que no ha
+       podido empezar por el límite, es de tipo float.
+      -notify_interval: Es el tiempo mínimo en segundos entre dos encolados provocados por
+       cambios en los datos en un mismo proceso, es de tipo float."""
+
+
+    def __init__(self, app, max_workers, min_intervals, timeout, retry, notify_interval):
+        self.app = app
+        self.max_workers = max_workers
+        self.min_intervals = min_intervals
+        self.timeout = timeout
+        self.retry = retry
+        self.notify_interval = notify_interval
+        self._pool = None
+        self._pid = None
+        self._notifier_pid = None
+        self._changed = threading.Event()
+        self._lock = threading.Lock()
+
+    def notify(self):
+        # Marca que los datos han cambiado. Un único hilo por proceso, que se arranca aquí la
+        # primera vez, encola los informes fuera de la petición.
+        with self._lock:
+            if self._notifier_pid != os.getpid():
+                self._changed = threading.Event()
+                threading.Thread(target=self._notifier, name='report-notifier', daemon=True).start()
+                self._notifier_pid = os.getpid()
+        self._changed.set()
+
+    def _notifier(self):
+        # Espera avisos de cambios y encola todos los informes, como mucho una vez cada
+        # notify_interval segundos; los avisos que llegan mientras tanto se agrupan. Los
+        # errores se registran en el log y el hilo sigue esperando.
+        changed = self._changed
+        while True:
+            changed.wait()
+            changed.clear()
+            try:
+                with self.app.app_context():
+                    self.submit_all()
+            except Exception:
+                self.app.logger.exception('Could not queue reports after a data change')
+            time.sleep(self.notify_interval)
+
+    def pool(self):
+        # El pool se crea en el primer uso de cada proceso, ya que no sobrevive al fork de los
+        # workers de gunicorn. Sus procesos se arrancan con spawn para no heredar los hilos
+        # ni las conexiones del worker web.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._pool
+
+    def submit(self, name):
+        # Encola el informe si no tiene ya un trabajo pendiente y devuelve el id de su trabajo
+        # pendiente. El trabajo empieza cuando haya pasado el intervalo mínimo desde el
+        # anterior.
+        now = datetime.utcnow()
+        with db.engine.begin() as connection:
+            expire_report_jobs(connection, self.timeout)
+            last_created = connection.execute(
+                db.select(func.max(ReportJob.created_at)).where(ReportJob.name == name)
+            ).scalar()
+            interval = timedelta(seconds=self.min_intervals.get(name, self.min_intervals['default']))
+            not_before = max(now, last_created + interval) if last_created is not None else now
+
+            pending = db.select(ReportJob.id).where(ReportJob.name == name, ReportJob.status == 'pending')
+            inserted = connection.execute(
+                db.insert(ReportJob).from_select(
+                    ['name', 'status', 'created_at', 'not_before', 'owner'],
+                    db.select(db.literal(name), db.literal('pending'), db.literal(now, db.DateTime),
+                              db.literal(not_before, db.DateTime), db.literal(os.getpid()))
+                    .where(~pending.exists())
+                )
+            )
+            if not inserted.rowcount:
+                return connection.execute(pending).scalar()
+            job_id = inserted.lastrowid
+
+        self.schedule(job_id, name, (not_before - now).total_seconds())
+        return job_id
+
+    def submit_all(self):
+        return {name: self.submit(name) for name in REPORTS}
+
+    def schedule(self, job_id, name, delay):
+        timer = threading.Timer(delay, self.start, (job_id, name))
+        timer.daemon = True
+        timer.start()
+
+    def start(self, job_id, name):
+        # Intenta pasar el trabajo a 'running' y, si lo consigue, lo envía al pool. Si no
+        # puede empezar por el límite, lo reintenta más tarde; si ya no está pendiente (ha
+        # caducado), lo abandona.
+        with self.app.app_context():
+            other = db.aliased(ReportJob)
+            running = db.select(func.count()).select_from(other).where(other.status == 'running').scalar_subquery()
+            same_report = db.select(other.id).where(other.name == name, other.status == 'running')
+            with db.engine.begin() as connection:
+                claimed = connection.execute(
+                    db.update(ReportJob)
+                    .where(ReportJob.id == job_id, ReportJob.status == 'pending',
+                           ~same_report.exists(), running < self.max_workers)
+                    .values(status='running', started_at=datetime.utcnow())
+                ).rowcount
+                still_pending = claimed or connection.execute(
+                    db.select(ReportJob.id).where(ReportJob.id == job_id, ReportJob.status == 'pending')
+                ).first() is not None
+
+            if not claimed:
+                if still_pending:
+                    self.schedule(job_id, name, self.retry)
+                return
+
+            config = {key: value for key, value in self.app.config.items() if key.startswith(REPORT_CONFIG_PREFIXES)}
+            try:
+                future = self.pool().submit(run_report_job, config, job_id, name)
+            except RuntimeError as error:
+                # El proceso se está cerrando y el pool ya no acepta trabajos
+                self.abandon(job_id, f'Abandoned: {error}')
+                return
+            future.add_done_callback(lambda future: self.finished(future, job_id, name))
+
+    def finished(self, future, job_id, name):
+        # Si el proceso del pool murió sin terminar el trabajo, lo marca como fallido
+        error = future.exception()
+        if error is None:
+            return
+        self.app.logger.error('Report %s (job %s) failed: %s', name, job_id, error)
+        with self.app.app_context():
+            self.abandon(job_id, str(error))
+
+    def abandon(self, job_id, error):
+        # Marca como fallido un trabajo en marcha que no se ha podido calcular
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.update(ReportJob).where(ReportJob.id == job_id, ReportJob.status == 'running')
+                .values(status='failed', finished_at=datetime.utcnow(), error=error)
+            )
+
+    def stats(self):
+        # Trabajos en marcha y pendientes en todos los procesos
+        counts = dict(db.session.execute(
+            db.select(ReportJob.status, func.count())
+            .where(ReportJob.status.in_(('pending', 'running')))
+            .group_by(ReportJob.status)
+        ).all())
+        return {'running': counts.get('running', 0), 'queued': counts.get('pending', 0), 'max_workers': self.max_workers}
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def expire_report_jobs(connection, timeout):
+    # Marca como fallidos los trabajos pendientes o en marcha cuyo proceso ya no existe o
+    # que llevan más de timeout segundos sin terminar
+    now = datetime.utcnow()
+    rows = connection.execute(
+        db.select(ReportJob.id, ReportJob.owner, ReportJob.created_at, ReportJob.started_at)
+        .where(ReportJob.status.in_(('pending', 'running')))
+    ).all()
+    for job_id, owner, created_at, started_at in rows:
+        if owner is not None and not process_alive(owner):
+            error = 'Abandoned: process exited'
+        elif now - (started_at or created_at) > timedelta(seconds=timeout):
+            error = 'Abandoned: timed out'
+        else:
+            continue
+        connection.execute(
+            db.update(ReportJob).where(ReportJob.id == job_id, ReportJob.status.in_(('pending', 'running')))
+            .values(status='failed', finished_at=now, error=error)
+        )
+
+
+def execute_report(job_id, name, keep):
+    # Calcula el informe de un trabajo en marcha y guarda el resultado o el error. Después
+    # borra los trabajos terminados del informe que excedan keep.
+    db.session.execute(db.update(ReportJob).where(ReportJob.id == job_id).values(owner=os.getpid()))
+    db.session.commit()
+    try:
+        result = json.dumps(REPORTS[name](), default=str)
+    except Exception as error:
+        db.session.rollback()
+        current_app.logger.exception('Report %s (job %s) failed', name, job_id)
+        values = {'status': 'failed', 'error': str(error)}
+    else:
+        values = {'status': 'done', 'result': result}
+    db.session.execute(
+        db.update(ReportJob).where(ReportJob.id == job_id).values(finished_at=datetime.utcnow(), **values)
+    )
+
+    kept = (
+        db.select(ReportJob.id)
+        .where(ReportJob.name == name, ReportJob.status.in_(('done', 'failed')))
+        .order_by(ReportJob.id.desc())
+        .limit(keep)
+    )
+    db.session.execute(
+        db.delete(ReportJob)
+        .where(ReportJob.name == name, ReportJob.status.in_(('done', 'failed')), ReportJob.id.not_in(kept))
+    )
+    db.session.commit()
+
+
+""" Proceso del pool de informes. Cada proceso crea una sola vez una aplicación con la
+ configuración de la base de datos y de los informes del worker que le envía el trabajo. """
+
+REPORT_CONFIG_PREFIXES = ('SQLALCHEMY_', 'SQLITE_', 'REPORT_', 'FORECAST_')
+_report_apps = {}
+
+
+def run_report_job(config, job_id, name):
+    key = json.dumps(config, sort_keys=True, default=str)
+    if key not in _report_apps:
+        _report_apps[key] = create_app(config)
+    app = _report_apps[key]
+    with app.app_context():
+        execute_report(job_id, name, app.config['REPORT_KEEP_JOBS'])
+
+
+def report_runner():
+    # Devuelve el ejecutor de informes de la aplicación actual
+    return current_app.extensions['report_runner']
+
+
+def latest_report(name):
+    # Devuelve el último trabajo terminado del informe o None si aún no hay ninguno
+    return (
+        ReportJob.query
+        .filter(ReportJob.name == name, ReportJob.status == 'done')
+        .order_by(ReportJob.finished_at.desc())
+        .first()
+    )
+
+
+def report_job_status(job):
+    return {
+        'id': job.id,
+        'name': job.name,
+        'status': job.status,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'error': job.error,
+    }
+
+
+""" Comando de consola para recalcular todos los informes en el momento, por ejemplo desde
+ cron: flask --app main refresh-reports """
+@click.command('refresh-reports')
+@with_appcontext
+def refresh_reports_command():
+    with db.engine.begin() as connection:
+        expire_report_jobs(connection, current_app.config['REPORT_JOB_TIMEOUT'])
+    for name in REPORTS:
+        now = datetime.utcnow()
+        job = ReportJob(name=name, status='running', created_at=now, not_before=now, started_at=now, owner=os.getpid())
+        db.session.add(job)
+        db.session.commit()
+        execute_report(job.id, name, current_app.config['REPORT_KEEP_JOBS'])
+        print(f'{name}: {db.session.get(ReportJob, job.id).status}')
+
+
+""" Caché condicional HTTP. Las páginas que solo dependen de los datos y del usuario llevan
+ un ETag y un Last-Modified calculados a partir de la versión de los datos y del último
+ informe terminado, así que el navegador puede volver a pedirlas con If-None-Match /
+ If-Modified-Since y recibir un 304 con una sola consulta por clave primaria, sin que se
+ ejecute la vista. Ambos valores están en la base de datos y son los mismos en todos los
+ procesos. """
+
+def page_version():
+    # Devuelve la versión de los datos, el momento del último cambio y el del último informe
+    # terminado con una sola consulta
+    last_report = (
+        db.select(func.max(ReportJob.finished_at)).where(ReportJob.status == 'done').scalar_subquery()
+    )
+    row = db.session.execute(
+        db.select(DataVersion.version, DataVersion.modified_at, last_report).where(DataVersion.id == 1)
+    ).first()
+    return tuple(row) if row is not None else (0, DATA_VERSION_EPOCH, None)
+
+
+def page_etag(user, version, report_finished_at):
+    # ETag débil de una página para el usuario, la versión de los datos y el último informe
+    token = f'{version}:{report_finished_at}:{user.id}:{user.is_admin}'
+    return hashlib.sha1(token.encode('utf-8')).hexdigest()[:20]
+
+
+def conditional_page(view):
+    # Decorador para las vistas de páginas: responde 304 si el navegador ya tiene la versión
+    # actual y, si no, añade a la respuesta el ETag, el Last-Modified y Cache-Control: no-cache
+    # para que el navegador la revalide en cada visita.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user = current_user()
+        if user is None or request.method not in ('GET', 'HEAD'):
+            return view(*args, **kwargs)
+
+        version, modified_at, report_finished_at = page_version()
+        etag = page_etag(user, version, report_finished_at)
+        last_modified = max(modified_at, report_finished_at or modified_at).replace(microsecond=0, tzinfo=timezone.utc)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
+
+""" Compresión de respuestas. Las respuestas de texto (HTML, JSON, CSS, JavaScript) de más
+ de COMPRESS_MIN_SIZE bytes se comprimen con brotli, si está instalado y el cliente lo
+ acepta, o con gzip. Las respuestas en streaming y las que ya vienen comprimidas (las
+ exportaciones) o se envían desde un fichero (static) se dejan como están. """
+
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/javascript'}
+
+
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding == 'br':
+        data = brotli.compress(data, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+    elif encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=current_app.config['COMPRESS_GZIP_LEVEL'], mtime=0)
+    else:
+        return response
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+""" Paginación por cursor (keyset). En lugar de OFFSET, cada página continúa a partir de
+ los valores (columna de orden, id) de la última fila de la anterior, así que el coste de
+ una página no depende de lo lejos que esté del principio. Todas las columnas de orden
+ tienen un índice que empieza por ellas (ver los modelos y upgrade_schema). """
+
+PRODUCT_SORT_COLUMNS = ('id', 'name', 'precio_costo', 'precio_venta', 'stock', 'quantity')
+SUPPLIER_SORT_COLUMNS = ('id', 'company_name', 'cif')
+
+
+def encode_cursor(value, last_id):
+    return base64.urlsafe_b64encode(json.dumps([value, last_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Devuelve el par (valor, id) del cursor. Un cursor mal formado, o que no contiene un
+    # valor escalar y un id entero, responde 400.
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError):
+        abort(400)
+    if not isinstance(decoded, list) or len(decoded) != 2:
+        abort(400)
+    value, last_id = decoded
+    if (not isinstance(value, (str, int, float)) or not isinstance(last_id, int)
+            or isinstance(value, bool) or isinstance(last_id, bool)):
+        abort(400)
+    return value, last_id
+
+
+def keyset_page(query, model, sort, cursor, page_size, descending=False):
+    # Devuelve una página de la consulta ordenada por (sort, id) y el cursor de la página
+    # siguiente, o None si no hay más filas. Pide una fila de más para saberlo.
+    column = getattr(model, sort)
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        if descending:
+            query = query.filter(tuple_(column, model.id) < tuple_(value, last_id))
+        else:
+            query = query.filter(tuple_(column, model.id) > tuple_(value, last_id))
+
+    if descending:
+        query = query.order_by(column.desc(), model.id.desc())
+    else:
+        query = query.order_by(column, model.id)
+    rows = query.limit(page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(getattr(rows[-1], sort), rows[-1].id)
+    return rows, next_cursor
+
+
+def page_size_arg():
+    # Lee el tamaño de página de la petición y lo limita al máximo configurado
+    page_size = request.args.get('per_page', current_app.config['DASHBOARD_PAGE_SIZE'], type=int)
+    return max(1, min(page_size, current_app.config['DASHBOARD_MAX_PAGE_SIZE']))
+
+
+def sort_arg(name, allowed):
+    sort = request.args.get(name, 'id')
+    return sort if sort in allowed else 'id'
+
+
+def page_url(**changes):
+    # Construye la URL de la página actual cambiando solo los parámetros indicados
+    args = request.args.to_dict()
+    args.update(changes)
+    return url_for(request.endpoint, **{key: value for key, value in args.items() if value is not None})
+
+
+""" Comando de consola para reconstruir los agregados totales y por periodo:
+ flask --app main rebuild-stats """
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    rebuild_supplier_stats()
+    rebuild_sale_rollups()
+    print('Supplier stats and sales rollups rebuilt')
+
 
 """ Ruta principal. Esta es la ruta principal de la aplicación. Cuando un usuario accede
 a la ruta raíz ("/"), se renderiza la plantilla HTML llamada "index.html". """
-@app.route('/')
+@bp.route('/')
 def index():
     return render_template('index.html')
 
@@ -146,7 +1787,7 @@ def index():
 una solicitud POST con un nombre de usuario y contraseña válidos, el usuario 
 iniciará sesión y se establecerá la sesión del usuario. En caso contrario, se 
 mostrará un mensaje de error. """
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     # Implementación de la ruta de inicio de sesión
     # Permite a los usuarios iniciar sesión utilizando un formulario de inicio de sesión
@@ -162,8 +1803,9 @@ def login():
 
         if user:
             session['user_id'] = user.id
+            user_cache().put(AuthenticatedUser(user.id, user.username, user.is_admin))
             flash('Login successful', 'success')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         else:
             flash('Invalid username or password', 'error')
 
@@ -174,7 +1816,7 @@ def login():
 """  Ruta de logout. Esta ruta maneja la funcionalidad de cierre de sesión. Cuando un 
  usuario accede a esta ruta, se borra la sesión del usuario y se redirige a la página
  de inicio de sesión. """
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     # Implementación de la ruta de cierre de sesión
     # Elimina la sesión del usuario y redirige a la página de inicio de sesión
@@ -182,58 +1824,85 @@ def logout():
 
     session.pop('user_id', None)
     flash('Logged out successfully', 'success')
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
 """ Ruta de panel de control. Esta ruta maneja la funcionalidad del panel de control.
 Si el usuario ha iniciado sesión, se renderiza la plantilla HTML correspondiente."""
-@app.route('/dashboard')
+@bp.route('/dashboard')
+@conditional_page
 def dashboard():
     # Implementación de la ruta del panel de control
     # Verifica si el usuario ha iniciado sesión antes de mostrar el panel de control
     # Redirige al usuario a la página de inicio de sesión si no ha iniciado sesión
-    # Obtiene el ID de usuario de la sesión y recupera el objeto de usuario correspondiente de la base de datos
-    # Consulta productos con un stock bajo y los filtra por aquellos que tienen un stock menor o igual al 90% de su cantidad
-    # Si el usuario es un administrador, obtiene todos los productos y proveedores de la base de datos
+    # Obtiene el usuario de la sesión de la caché de usuarios, que solo consulta la base de datos si no lo tiene o ha caducado
+    # Consulta productos con un stock bajo (stock por debajo de su umbral, por defecto el 90% de su cantidad) ordenados de mayor a menor déficit
+    # Si el usuario es un administrador, obtiene una página de productos (con su proveedor cargado en la misma consulta) y otra de proveedores
+    # Para el administrador lee también el último informe de previsión de reposición
+    # Las tablas se paginan por cursor con los parámetros per_page, product_sort, product_after, supplier_sort, supplier_after y low_stock_after
     # Renderiza la plantilla HTML "admin_dashboard.html" con los productos, proveedores y productos de bajo stock
     # Si el usuario no es un administrador, renderiza la plantilla HTML "client_dashboard.html" con los productos de bajo stock
 
 
 
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
+    user = current_user()
+    if user is None:
+        return redirect(url_for('main.login'))
 
-    user_id = session['user_id']
-    user = User.query.get(user_id)
+    page_size = page_size_arg()
 
-    low_stock_products = Product.query.filter(Product.stock <= 0.9 * Product.quantity)
+    low_stock_products, low_stock_next = keyset_page(
+        low_stock_query(), Product, 'stock_shortfall', request.args.get('low_stock_after'), page_size, descending=True)
+    low_stock_next_url = page_url(low_stock_after=low_stock_next) if low_stock_next else None
 
     if user.is_admin:
-        products = Product.query.all()
-        suppliers = Supplier.query.all()
-        return render_template('admin_dashboard.html', products=products, suppliers=suppliers, low_stock_products=low_stock_products)
+        product_sort = sort_arg('product_sort', PRODUCT_SORT_COLUMNS)
+        products, products_next = keyset_page(
+            Product.query.join(Product.supplier).options(contains_eager(Product.supplier)),
+            Product, product_sort, request.args.get('product_after'), page_size)
+
+        supplier_sort = sort_arg('supplier_sort', SUPPLIER_SORT_COLUMNS)
+        suppliers, suppliers_next = keyset_page(
+            Supplier.query, Supplier, supplier_sort, request.args.get('supplier_after'), page_size)
+
+        # La previsión de reposición sale del último informe terminado; si aún no hay ninguno
+        # se encola y la plantilla indica que se está calculando
+        forecast_job = latest_report('restock_forecast')
+        if forecast_job is None:
+            report_runner().submit('restock_forecast')
+            forecast = None
+        else:
+            forecast = json.loads(forecast_job.result)
+            forecast['products'] = forecast['products'][:current_app.config['FORECAST_DASHBOARD_ROWS']]
+
+        return render_template('admin_dashboard.html', products=products, suppliers=suppliers, low_stock_products=low_stock_products,
+                               products_next_url=page_url(product_after=products_next) if products_next else None,
+                               suppliers_next_url=page_url(supplier_after=suppliers_next) if suppliers_next else None,
+                               low_stock_next_url=low_stock_next_url, forecast=forecast,
+                               first_page_url=url_for('main.dashboard', per_page=page_size, product_sort=product_sort, supplier_sort=supplier_sort))
     else:
-        return render_template('client_dashboard.html', low_stock_products=low_stock_products)
+        return render_template('client_dashboard.html', low_stock_products=low_stock_products,
+                               low_stock_next_url=low_stock_next_url, first_page_url=url_for('main.dashboard', per_page=page_size))
 
 
 
 # Ruta de agregar un producto
-@app.route('/add_product', methods=['GET', 'POST'])
+@bp.route('/add_product', methods=['GET', 'POST'])
 def add_product():
     # Implementación de la ruta para agregar un producto
     # Verifica si el usuario ha iniciado sesión antes de permitir agregar un producto
     # Redirige al usuario a la página de inicio de sesión si no ha iniciado sesión
 
 
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
+    if current_user() is None:
+        return redirect(url_for('main.login'))
 
     if request.method == 'POST':
         # Procesa el formulario cuando se envía por el método POST
         # Crea un nuevo objeto de Producto
-        # Obtiene los datos del formulario (nombre, descripción, precio de costo, precio de venta, stock, cantidad y ID del proveedor)
+        # Obtiene los datos del formulario (nombre, descripción, precio de costo, precio de venta, stock, cantidad, ID del proveedor y umbral de bajo stock opcional)
         # Crea un nuevo objeto de Producto con los datos proporcionados
-        # Agrega el nuevo producto a la sesión de la base de datos
+        # Agrega el nuevo producto a la sesión de la base de datos y calcula su déficit de stock
         # Realiza la confirmación de la sesión para guardar los cambios en la base de datos
         # Muestra un mensaje flash indicando que el producto se agregó correctamente
         # Redirige al usuario al panel de control
@@ -246,14 +1915,19 @@ def add_product():
         stock = int(request.form['stock'])
         quantity = int(request.form['quantity'])
         supplier_id = int(request.form['supplier'])
+        low_stock_threshold = request.form.get('low_stock_threshold', type=float)
 
-        product = Product(name=name, description=description, precio_costo=precio_costo, precio_venta=precio_venta, stock=stock, quantity=quantity, supplier_id=supplier_id)
+        product = Product(name=name, description=description, precio_costo=precio_costo, precio_venta=precio_venta, stock=stock, quantity=quantity, supplier_id=supplier_id,
+                          low_stock_threshold=low_stock_threshold)
         
         db.session.add(product)
+        db.session.flush()
+        refresh_stock_shortfall(Product.id == product.id)
+        bump_data_version()
         db.session.commit()
 
         flash('Product added successfully', 'success')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
 
     # Obtiene todos los proveedores de la base de datos
     # Renderiza la plantilla HTML "add_product.html" con la lista de proveedores
@@ -263,18 +1937,18 @@ def add_product():
 
 
 # Ruta de agregar un proveedor. Esta ruta maneja la funcionalidad de agregar un proveedor.
-@app.route('/add_supplier', methods=['GET', 'POST'])
+@bp.route('/add_supplier', methods=['GET', 'POST'])
 def add_supplier():
     # Implementación de la ruta para agregar un proveedor
     # Verifica si el usuario ha iniciado sesión antes de permitir agregar un proveedor
     # Redirige al usuario a la página de inicio de sesión si no ha iniciado sesión
 
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
+    if current_user() is None:
+        return redirect(url_for('main.login'))
 
     if request.method == 'POST':
         # Procesa el formulario cuando se envía por el método POST
-        # Obtiene los datos del formulario (nombre de la empresa, teléfono, dirección y CIF)
+        # Obtiene los datos del formulario (nombre de la empresa, teléfono, dirección, CIF y umbral de bajo stock opcional)
         # Crea un nuevo objeto de Proveedor con los datos proporcionados
         # Agrega el nuevo proveedor a la sesión de la base de datos
         # Realiza la confirmación de la sesión para guardar los cambios en la base de datos
@@ -285,61 +1959,70 @@ def add_supplier():
         phone = request.form['phone']
         address = request.form['address']
         cif = request.form['cif']
+        low_stock_threshold = request.form.get('low_stock_threshold', type=float)
 
-        supplier = Supplier(company_name=company_name, phone=phone, address=address, cif=cif)
+        supplier = Supplier(company_name=company_name, phone=phone, address=address, cif=cif, low_stock_threshold=low_stock_threshold)
         db.session.add(supplier)
+        bump_data_version()
         db.session.commit()
 
         flash('Supplier added successfully', 'success')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     # Renderiza la plantilla HTML "add_supplier.html"
     return render_template('add_supplier.html')
 
 
 # Ruta para agregar una venta. Esta ruta maneja la funcionalidad de agregar una venta.
-@app.route('/add_sale', methods=['POST'])
+@bp.route('/add_sale', methods=['POST'])
 def add_sale():
     # Implementación de la ruta para agregar una venta
     # Verifica si el usuario ha iniciado sesión antes de permitir agregar una venta
     # Redirige al usuario a la página de inicio de sesión si no ha iniciado sesión
 
 
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
+    if current_user() is None:
+        return redirect(url_for('main.login'))
 
     if request.method == 'POST':
         # Procesa el formulario cuando se envía por el método POST
         # Obtiene los datos del formulario (ID del producto y cantidad)
-        # Obtiene el objeto del producto correspondiente al ID proporcionado
-        # Verifica si el producto existe en la base de datos
-        # Si el producto no existe, muestra un mensaje flash de error y redirige al panel de control
-        # Verifica si la cantidad solicitada excede el stock disponible del producto
-        # Si la cantidad es mayor que el stock, muestra un mensaje flash de error y redirige al panel de control
+        # Verifica que la cantidad sea positiva
+        # Resta la cantidad al stock con un UPDATE condicional que solo se aplica si hay stock suficiente
+        # Si no se actualiza ninguna fila, deshace la transacción y muestra un mensaje flash de error (producto inexistente o stock insuficiente)
         # Crea un nuevo objeto de Venta con los datos proporcionados (fecha de venta, nombre del producto, nombre del proveedor, cantidad, precio de venta, precio total, precio de costo, ganancia total)
-        # Actualiza el stock del producto restando la cantidad vendida
         # Agrega la nueva venta a la sesión de la base de datos
-        # Realiza la confirmación de la sesión para guardar los cambios en la base de datos
+        # Realiza la confirmación de la sesión para guardar el stock y la venta en la misma transacción
         # Muestra un mensaje flash indicando que la venta se agregó correctamente
         # Redirige al usuario al panel de control
 
         product_id = int(request.form['product'])
         quantity = int(request.form['quantity'])
 
-        product = Product.query.get(product_id)
+        if quantity <= 0:
+            flash('Invalid quantity', 'error')
+            return redirect(url_for('main.dashboard'))
+
+        product = decrement_stock(product_id, quantity)
 
         if product is None:
-            flash('Invalid product', 'error')
-            return redirect(url_for('dashboard'))
+            db.session.rollback()
+            if db.session.get(Product, product_id) is None:
+                flash('Invalid product', 'error')
+            else:
+                flash('Insufficient stock', 'error')
+            return redirect(url_for('main.dashboard'))
 
-        if quantity > product.stock:
-            flash('Insufficient stock', 'error')
-            return redirect(url_for('dashboard'))
+        supplier_name = db.session.execute(
+            db.select(Supplier.company_name).where(Supplier.id == product.supplier_id)
+        ).scalar_one()
 
         sale = Sale(
             sale_date=datetime.now().date(),
+            product_id=product_id,
+            supplier_id=product.supplier_id,
             product_name=product.name,
-            supplier_name=product.supplier.company_name,
+            supplier_name=supplier_name,
             quantity=quantity,
             selling_price=product.precio_venta,
             total_price=product.precio_venta * quantity,
@@ -347,127 +2030,616 @@ def add_sale():
             total_profit=(product.precio_venta - product.precio_costo) * quantity
         )
 
-        product.stock -= quantity
         db.session.add(sale)
+
+        # Actualiza los agregados del proveedor en la misma transacción que la venta
+        record_supplier_sale(product.supplier_id, quantity, sale.total_price, sale.cost_price, sale.total_profit)
+        record_sale_rollups([{
+            'sale_date': sale.sale_date, 'product_id': product_id, 'supplier_id': product.supplier_id, 'quantity': quantity,
+            'total_price': sale.total_price, 'cost_price': sale.cost_price, 'total_profit': sale.total_profit,
+        }])
+        bump_data_version()
         db.session.commit()
 
         flash('Sale added successfully', 'success')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
 
     # Redirige al usuario al panel de control
-    return redirect(url_for('dashboard'))
+    return redirect(url_for('main.dashboard'))
 
 
-# Ruta 
-@app.route('/charts')
-def charts():
-    # Implementación de la ruta para mostrar gráficos
-    # Verifica si el usuario ha iniciado sesión antes de mostrar los gráficos
-    # Redirige al usuario a la página de inicio de sesión si no ha iniciado sesión
+""" Funciones que generan los datos de cada gráfico. Se llaman solo cuando el gráfico no
+ está en la caché para la versión actual de los datos. """
 
+def render_charts_figure(totals):
+    # Plotly se importa aquí y no al cargar el módulo: solo lo necesita este gráfico
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
 
-
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-
-    # Obtiene todos los proveedores de la base de datos
-    suppliers = Supplier.query.all()
-
-    # Inicializa listas para almacenar datos de ventas y ganancias por proveedor
-    sales_data = []
-    profits_data = []
-
-    # Itera sobre los proveedores y obtiene las ventas y ganancias totales para cada proveedor
-    for supplier in suppliers:
-        # Obtiene todas las ventas asociadas al proveedor actual
-        supplier_sales = Sale.query.filter_by(supplier_name=supplier.company_name).all()
-        
-        # Calcula el total de ventas sumando la cantidad vendida en cada venta
-        total_sales = sum([sale.quantity for sale in supplier_sales])
-        
-        # Calcula las ganancias totales sumando las ganancias en cada venta
-        total_profits = sum([sale.total_profit for sale in supplier_sales])
-        
-        # Agrega los datos de ventas y ganancias a las listas correspondientes
-        sales_data.append(total_sales)
-        profits_data.append(total_profits)
+    # Las ventas y ganancias totales de cada proveedor vienen del informe supplier_totals
+    supplier_names, sales_data, profits_data = totals['labels'], totals['sales'], totals['profits']
 
     # Crea una figura con dos gráficos de barras
     fig = make_subplots(rows=1, cols=2, subplot_titles=("Sales by Supplier", "Profits by Supplier"))
 
     # Agrega el gráfico de barras de ventas al primer subplot
-    fig.add_trace(go.Bar(x=[supplier.company_name for supplier in suppliers], y=sales_data, name='Sales'), row=1, col=1)
+    fig.add_trace(go.Bar(x=supplier_names, y=sales_data, name='Sales'), row=1, col=1)
     
     # Agrega el gráfico de barras de ganancias al segundo subplot
-    fig.add_trace(go.Bar(x=[supplier.company_name for supplier in suppliers], y=profits_data, name='Profits'), row=1, col=2)
+    fig.add_trace(go.Bar(x=supplier_names, y=profits_data, name='Profits'), row=1, col=2)
 
     # Configura el diseño del gráfico para ocultar la leyenda
     fig.update_layout(showlegend=False)
 
-    # Convierte la figura en HTML para poder mostrarla en la plantilla
-    sales_chart_div = fig.to_html(full_html=False)
-    profits_chart_div = fig.to_html(full_html=False)
+    # Convierte la figura en JSON; la plantilla la dibuja con el plotly.js estático versionado
+    return fig.to_json()
+
+
+def supplier_chart_data(field, start=None, end=None, granularity='day', view='bar'):
+    # Devuelve los datos del gráfico indicado ('sales' o 'profits') listos para serializarse
+    # en JSON: etiquetas y valores por proveedor para el gráfico de barras, o periodos y una
+    # serie por proveedor para la serie temporal.
+    if view == 'timeseries':
+        return supplier_time_series(field, start, end, granularity)
+
+    supplier_names, sales_data, profits_data = supplier_totals(start, end)
+    values = sales_data if field == 'sales' else profits_data
+    return {'labels': supplier_names, 'values': values}
+
+
+def chart_args():
+    # Lee de la petición el rango de fechas (from, to en formato AAAA-MM-DD), la granularidad
+    # ('day' o 'month') y el tipo de gráfico ('bar' o 'timeseries').
+    try:
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        abort(400)
+
+    granularity = request.args.get('granularity', 'day')
+    view = request.args.get('view', 'bar')
+    if granularity not in ('day', 'month') or view not in ('bar', 'timeseries'):
+        abort(400)
+    return start, end, granularity, view
+
+
+def cached_chart_data(field):
+    start, end, granularity, view = chart_args()
+    name = f'{field}_data:{view}:{granularity}:{start}:{end}'
+    return chart_cache().get_or_render(name, lambda: supplier_chart_data(field, start, end, granularity, view))
+
+
+""" plotly.js se sirve una sola vez como fichero estático en lugar de incrustarse en cada
+ respuesta. El fichero se copia desde el paquete de plotly instalado la primera vez que se
+ pide un gráfico y se enlaza con la versión de plotly en la URL, de modo que puede guardarse
+ en caché indefinidamente. """
+
+def write_plotly_js(force=False):
+    # Copia el bundle de plotly.js a la carpeta static si aún no existe. Se escribe en un
+    # fichero temporal que luego se renombra, así que otro proceso nunca ve ni sirve un
+    # fichero a medias aunque varios lo escriban a la vez.
+    path = os.path.join(current_app.static_folder, current_app.config['PLOTLY_JS_FILENAME'])
+    if force or not os.path.exists(path):
+        import plotly.offline
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=current_app.static_folder,
+                                         prefix='.plotly-', suffix='.tmp', delete=False) as f:
+            try:
+                f.write(plotly.offline.get_plotlyjs())
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+    return path
+
+
+def inject_plotly_js():
+    # Añade a las plantillas la URL versionada de plotly.js
+    return {'plotly_js_url': url_for('static', filename=current_app.config['PLOTLY_JS_FILENAME'],
+                                     v=current_app.config['PLOTLY_JS_VERSION'])}
+
+
+def cache_plotly_js(response):
+    # Marca plotly.js como inmutable para que el navegador lo descargue una sola vez
+    if request.endpoint == 'static' and request.view_args.get('filename') == current_app.config['PLOTLY_JS_FILENAME']:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['PLOTLY_JS_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+
+""" Comando de consola para regenerar plotly.js: flask --app main vendor-plotly """
+@click.command('vendor-plotly')
+@with_appcontext
+def vendor_plotly_command():
+    print(f'plotly.js written to {write_plotly_js(force=True)}')
+
+
+""" Ruta de ventas por lotes. Permite a los terminales de venta subir de una vez todas las
+ líneas de un turno en CSV, JSON o JSON por líneas. Cada línea se acepta o se rechaza por
+ separado; la respuesta indica cuántas se aceptaron y qué líneas se rechazaron y por qué.
+ Todas las ventas aceptadas se confirman juntas al final: si la subida se interrumpe o la
+ escritura falla, no se guarda ninguna y el lote se puede reenviar entero. """
+@bp.route('/api/sales/batch', methods=['POST'])
+def api_sales_batch():
+    if current_user() is None:
+        return jsonify(error='Unauthorized'), 401
+
+    try:
+        accepted, errors = ingest_sales(read_sale_lines(), current_app.config['SALES_BATCH_CHUNK_SIZE'])
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return jsonify(accepted=accepted, rejected=len(errors), errors=errors)
 
-    # Renderiza la plantilla 'admin_dashboard.html' con los datos de los gráficos y los proveedores
-    return render_template('admin_dashboard.html', sales_chart_div=sales_chart_div, profits_chart_div=profits_chart_div, suppliers=suppliers)
 
-""" Ruta gráfico de ventas. Esta ruta maneja la funcionalidad del gráfico de ventas. 
- Obtiene los datos necesarios de la base de datos para generar el gráfico de ventas 
- utilizando la biblioteca Plotly. Luego, renderiza la plantilla HTML "sales_chart.html"
- con los datos necesarios para el gráfico. """
-@app.route('/sales_chart')
-def sales_chart():
-    # Implementación de la ruta del gráfico de ventas
-    # Obtiene datos de la base de datos para generar el gráfico de ventas utilizando Plotly
-    # Renderiza la plantilla HTML "sales_chart.html" con los datos necesarios para el gráfico
+# Ruta 
+@bp.route('/charts')
+@conditional_page
+def charts():
+    # Implementación de la ruta para mostrar gráficos
+    # Verifica si el usuario ha iniciado sesión antes de mostrar los gráficos
+    # Redirige al usuario a la página de inicio de sesión si no ha iniciado sesión
 
 
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
 
+    if current_user() is None:
+        return redirect(url_for('main.login'))
+
+    # Obtiene todos los proveedores de la base de datos
     suppliers = Supplier.query.all()
 
-    sales_data = []
-    for supplier in suppliers:
-        supplier_sales = Sale.query.filter_by(supplier_name=supplier.company_name).all()
-        total_sales = sum([sale.quantity for sale in supplier_sales])
-        sales_data.append(total_sales)
+    # Obtiene la figura en JSON de la caché o la genera a partir del último informe
+    # supplier_totals terminado. Solo si aún no hay ninguno (la primera vez) se calcula aquí
+    # mientras el informe se encola. La figura contiene los dos gráficos y se muestra una
+    # sola vez.
+    job = latest_report('supplier_totals')
+    if job is not None:
+        charts_figure = chart_cache().get_or_render(f'charts:{job.id}', lambda: render_charts_figure(json.loads(job.result)))
+    else:
+        report_runner().submit('supplier_totals')
+        charts_figure = chart_cache().get_or_render('charts', lambda: render_charts_figure(supplier_totals_report()))
+    write_plotly_js()
 
-    fig = go.Figure(data=go.Bar(x=[supplier.company_name for supplier in suppliers], y=sales_data))
-    sales_chart_div = fig.to_html(full_html=False)
+    # Renderiza la plantilla 'admin_dashboard.html' con el gráfico y los proveedores
+    return render_template('admin_dashboard.html', charts_figure=charts_figure, suppliers=suppliers)
 
-    return render_template('sales_chart.html', sales_chart_div=sales_chart_div)
+""" Ruta gráfico de ventas. Esta ruta maneja la funcionalidad del gráfico de ventas. 
+ Renderiza la plantilla HTML "sales_chart.html", que obtiene los datos de
+ /api/charts/sales y dibuja el gráfico en el navegador con plotly.js. """
+@bp.route('/sales_chart')
+@conditional_page
+def sales_chart():
+    # Implementación de la ruta del gráfico de ventas
+    # Renderiza la plantilla HTML "sales_chart.html"; los datos se piden a la API de gráficos
+    # con los mismos parámetros de rango de fechas, granularidad y tipo de gráfico
+
+
+    if current_user() is None:
+        return redirect(url_for('main.login'))
+
+    start, end, granularity, view = chart_args()
+    write_plotly_js()
+    return render_template('sales_chart.html', start=start, end=end, granularity=granularity, view=view)
 
 
 """ Ruta gráfico de beneficios. Esta ruta maneja la funcionalidad del gráfico de 
- beneficios. Obtiene los datos necesarios de la base de datos para generar el gráfico
-  de beneficios utilizando la biblioteca Plotly. Luego, renderiza la plantilla HTML 
- "profits_chart.html" con los datos necesarios para el gráfico. """
-@app.route('/profits_chart')
+ beneficios. Renderiza la plantilla HTML "profits_chart.html", que obtiene los datos
+ de /api/charts/profits y dibuja el gráfico en el navegador con plotly.js. """
+@bp.route('/profits_chart')
+@conditional_page
 def profits_chart():
     # Implementación de la ruta del gráfico de beneficios
-    # Obtiene datos de la base de datos para generar el gráfico de beneficios utilizando Plotly
-    # Renderiza la plantilla HTML "profits_chart.html" con los datos necesarios para el gráfico
-
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
+    # Renderiza la plantilla HTML "profits_chart.html"; los datos se piden a la API de gráficos
+    # con los mismos parámetros de rango de fechas, granularidad y tipo de gráfico
 
-    suppliers = Supplier.query.all()
+    if current_user() is None:
+        return redirect(url_for('main.login'))
 
-    profits_data = []
-    for supplier in suppliers:
-        supplier_sales = Sale.query.filter_by(supplier_name=supplier.company_name).all()
-        total_profits = sum([sale.total_profit for sale in supplier_sales])
-        profits_data.append(total_profits)
+    start, end, granularity, view = chart_args()
+    write_plotly_js()
+    return render_template('profits_chart.html', start=start, end=end, granularity=granularity, view=view)
 
-    fig = go.Figure(data=go.Bar(x=[supplier.company_name for supplier in suppliers], y=profits_data))
-    profits_chart_div = fig.to_html(full_html=False)
 
-    return render_template('profits_chart.html', profits_chart_div=profits_chart_div)
 
+""" Rutas de la API de gráficos. Devuelven en JSON compacto solo las etiquetas (proveedores)
+ y los valores de cada gráfico; las plantillas los dibujan en el navegador con plotly.js.
+ Aceptan los parámetros from, to, granularity y view descritos en chart_args(). """
+@bp.route('/api/charts/sales')
+def api_sales_chart():
+    if current_user() is None:
+        return jsonify(error='Unauthorized'), 401
+
+    return jsonify(cached_chart_data('sales'))
+
+
+@bp.route('/api/charts/profits')
+def api_profits_chart():
+    if current_user() is None:
+        return jsonify(error='Unauthorized'), 401
+
+    return jsonify(cached_chart_data('profits'))
+
+
+""" Ruta de la API de bajo stock. Devuelve en JSON los productos con bajo stock ordenados de
+ mayor a menor déficit. Recorre el índice de stock_shortfall, así que el coste depende del
+ tamaño de la página (limit, máximo DASHBOARD_MAX_PAGE_SIZE) y no del catálogo. """
+@bp.route('/api/low_stock')
+def api_low_stock():
+    if current_user() is None:
+        return jsonify(error='Unauthorized'), 401
+
+    limit = max(1, min(request.args.get('limit', current_app.config['DASHBOARD_PAGE_SIZE'], type=int), current_app.config['DASHBOARD_MAX_PAGE_SIZE']))
+    products, next_cursor = keyset_page(low_stock_query(), Product, 'stock_shortfall', request.args.get('after'), limit, descending=True)
+
+    return jsonify(
+        products=[
+            {'id': product.id, 'name': product.name, 'stock': product.stock, 'quantity': product.quantity,
+             'supplier_id': product.supplier_id, 'shortfall': product.stock_shortfall}
+            for product in products
+        ],
+        next=next_cursor,
+    )
+
+
+""" Ruta de la API de búsqueda de productos. Devuelve en JSON los productos cuyo nombre o
+ descripción contienen todas las palabras escritas en q (la última como prefijo), ordenados
+ por relevancia y limitados a limit resultados (por defecto PRODUCT_SEARCH_LIMIT, como mucho
+ PRODUCT_SEARCH_MAX_LIMIT). La usa el selector de productos del formulario de ventas. """
+@bp.route('/api/products/search')
+def api_product_search():
+    if current_user() is None:
+        return jsonify(error='Unauthorized'), 401
+
+    limit = max(1, min(request.args.get('limit', current_app.config['PRODUCT_SEARCH_LIMIT'], type=int), current_app.config['PRODUCT_SEARCH_MAX_LIMIT']))
+    results = search_products(request.args.get('q', ''), limit)
+
+    return jsonify(
+        products=[
+            {'id': product_id, 'name': name, 'stock': stock, 'precio_venta': precio_venta, 'supplier': supplier}
+            for product_id, name, stock, precio_venta, supplier in results
+        ]
+    )
+
+
+""" Rutas de informes. /api/reports/<nombre> devuelve el resultado del último trabajo
+ terminado del informe (supplier_totals, top_products o supplier_margin) o, si aún no hay
+ ninguno, lo encola y responde 202 con el id del trabajo. El estado de un trabajo se
+ consulta en /api/reports/jobs/<id> y un administrador puede pedir que se recalcule un
+ informe con POST /api/reports/<nombre>/refresh. """
+@bp.route('/api/reports/<name>')
+def api_report(name):
+    if current_user() is None:
+        return jsonify(error='Unauthorized'), 401
+    if name not in REPORTS:
+        abort(404)
+
+    job = latest_report(name)
+    if job is None:
+        job_id = report_runner().submit(name)
+        return jsonify(status='pending', job=job_id), 202
+
+    return jsonify(name=name, job=job.id, finished_at=job.finished_at.isoformat(), result=json.loads(job.result))
+
+
+@bp.route('/api/reports/<name>/refresh', methods=['POST'])
+def api_refresh_report(name):
+    user = current_user()
+    if user is None or not user.is_admin:
+        return jsonify(error='Unauthorized'), 401
+    if name not in REPORTS:
+        abort(404)
+
+    job_id = report_runner().submit(name)
+    return jsonify(status='pending', job=job_id), 202, {'Location': url_for('main.api_report_job', job_id=job_id)}
+
+
+@bp.route('/api/reports/jobs/<int:job_id>')
+def api_report_job(job_id):
+    if current_user() is None:
+        return jsonify(error='Unauthorized'), 401
+
+    job = db.session.get(ReportJob, job_id)
+    if job is None:
+        abort(404)
+    return jsonify(report_job_status(job))
+
+
+""" Ruta de la API de reposición. Devuelve la última previsión de reposición terminada: por
+ proveedor, los productos y unidades a pedir y su coste, y los productos a pedir con menos
+ días de stock. Con el parámetro supplier solo devuelve los de ese proveedor. Si aún no hay
+ ninguna previsión, la encola y responde 202 con el id del trabajo. """
+@bp.route('/api/restock')
+def api_restock():
+    if current_user() is None:
+        return jsonify(error='Unauthorized'), 401
+
+    supplier_id = request.args.get('supplier', type=int)
+    if request.args.get('supplier') and supplier_id is None:
+        abort(400)
+
+    job = latest_report('restock_forecast')
+    if job is None:
+        return jsonify(status='pending', job=report_runner().submit('restock_forecast')), 202
+
+    forecast = json.loads(job.result)
+    if supplier_id is not None:
+        forecast['suppliers'] = [supplier for supplier in forecast['suppliers'] if supplier['id'] == supplier_id]
+        forecast['products'] = [product for product in forecast['products'] if product['supplier_id'] == supplier_id]
+    return jsonify(job=job.id, finished_at=job.finished_at.isoformat(), **forecast)
+
+
+""" Exportaciones. Las tablas de ventas, productos y proveedores se exportan en CSV o en JSON
+ por líneas sin cargarlas en memoria: la consulta se lee por bloques de EXPORT_BATCH_SIZE
+ filas con yield_per (el cursor de SQLite va entregando filas según se piden), cada bloque
+ se convierte en texto y, si el cliente acepta gzip, se comprime al vuelo antes de
+ enviarse. La memoria del worker depende del tamaño del bloque y no del de la tabla. """
+
+EXPORT_COLUMNS = {
+    'sales': (Sale, ['id', 'sale_date', 'product_id', 'product_name', 'supplier_id', 'supplier_name', 'quantity',
+                     'selling_price', 'total_price', 'cost_price', 'total_profit']),
+    'products': (Product, ['id', 'name', 'description', 'precio_costo', 'precio_venta', 'stock', 'quantity',
+                           'supplier_id', 'low_stock_threshold', 'stock_shortfall']),
+    'suppliers': (Supplier, ['id', 'company_name', 'phone', 'address', 'cif', 'low_stock_threshold']),
+}
+
+
+def export_args():
+    # Lee de la petición el formato (format: 'csv' o 'ndjson'), el rango de fechas (from, to
+    # en formato AAAA-MM-DD) y el proveedor (supplier, su id).
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        abort(400)
+    try:
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        abort(400)
+    supplier_id = request.args.get('supplier', type=int)
+    if request.args.get('supplier') and supplier_id is None:
+        abort(400)
+    return export_format, start, end, supplier_id
+
+
+def export_query(name, start, end, supplier_id):
+    # Consulta de la exportación indicada con sus filtros, ordenada por id. Las fechas solo se
+    # aplican a las ventas; el proveedor filtra ventas y productos por su proveedor y
+    # proveedores por su id.
+    model, columns = EXPORT_COLUMNS[name]
+    query = db.select(*[getattr(model, column) for column in columns]).order_by(model.id)
+    if name == 'sales':
+        if start is not None:
+            query = query.where(Sale.sale_date >= start)
+        if end is not None:
+            query = query.where(Sale.sale_date <= end)
+    if supplier_id is not None:
+        query = query.where((model.id if name == 'suppliers' else model.supplier_id) == supplier_id)
+    return query
+
+
+def export_chunks(query, columns, export_format):
+    # Genera el texto de la exportación bloque a bloque
+    result = db.session.execute(query.execution_options(yield_per=current_app.config['EXPORT_BATCH_SIZE']))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    if export_format == 'csv':
+        writer.writerow(columns)
+    for rows in result.partitions():
+        if export_format == 'csv':
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(columns, row)), default=str))
+                buffer.write('\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if export_format == 'csv' and buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_chunks(chunks):
+    # Comprime al vuelo en formato gzip el texto generado por chunks
+    compressor = zlib.compressobj(current_app.config['EXPORT_GZIP_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(name):
+    # Respuesta en streaming con la exportación indicada, comprimida si el cliente acepta gzip
+    export_format, start, end, supplier_id = export_args()
+    columns = EXPORT_COLUMNS[name][1]
+    chunks = export_chunks(export_query(name, start, end, supplier_id), columns, export_format)
+
+    headers = {'Content-Disposition': f'attachment; filename={name}.{export_format}'}
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    headers['Vary'] = 'Accept-Encoding'
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+
+""" Rutas de exportación. Devuelven en streaming la tabla de ventas, productos o proveedores
+ en CSV (por defecto) o JSON por líneas (format=ndjson). Las ventas admiten el rango de
+ fechas from y to, y las tres el filtro supplier. """
+@bp.route('/export/sales')
+def export_sales():
+    if current_user() is None:
+        return redirect(url_for('main.login'))
+
+    return export_response('sales')
+
+
+@bp.route('/export/products')
+def export_products():
+    if current_user() is None:
+        return redirect(url_for('main.login'))
+
+    return export_response('products')
+
+
+@bp.route('/export/suppliers')
+def export_suppliers():
+    if current_user() is None:
+        return redirect(url_for('main.login'))
+
+    return export_response('suppliers')
+
+
+""" Ruta de estadísticas de la caché de gráficos. Devuelve en JSON los aciertos y fallos de
+ la caché para poder comprobar su efectividad. """
+@bp.route('/charts/cache_stats')
+def chart_cache_stats():
+    if current_user() is None:
+        return redirect(url_for('main.login'))
+
+    return jsonify(chart_cache().stats())
+
+
+""" Ruta de métricas. Expone en formato de texto de Prometheus la latencia por ruta, las
+ consultas SQL, el tiempo de plantillas y los aciertos y fallos de las cachés de gráficos
+ y de usuarios. Estas métricas son del proceso que atiende la petición: con los workers de
+ gunicorn cada uno lleva sus propios contadores y cada petición a /metrics devuelve solo
+ los del worker que la atiende. Todas sus series llevan la etiqueta pid, de modo que los
+ contadores de workers distintos no se mezclan ni parecen reinicios, y se suman en
+ Prometheus (por ejemplo, sum without (pid) (rate(http_requests_total[5m]))). Los trabajos de informes en marcha y en cola salen
+ de la tabla report_job y ya son de todos los procesos, por eso no llevan pid. """
+@bp.route('/metrics')
+def metrics():
+    pid = os.getpid()
+    cache = chart_cache().stats()
+    users = user_cache().stats()
+    reports = report_runner().stats()
+    lines = [
+        current_app.extensions['request_metrics'].render_prometheus(),
+        '# HELP chart_cache_hits_total Chart cache hits.',
+        '# TYPE chart_cache_hits_total counter',
+        f'chart_cache_hits_total{{pid="{pid}"}} {cache["hits"]}',
+        '# HELP chart_cache_misses_total Chart cache misses.',
+        '# TYPE chart_cache_misses_total counter',
+        f'chart_cache_misses_total{{pid="{pid}"}} {cache["misses"]}',
+        '# HELP user_cache_hits_total Authenticated user cache hits.',
+        '# TYPE user_cache_hits_total counter',
+        f'user_cache_hits_total{{pid="{pid}"}} {users["hits"]}',
+        '# HELP user_cache_misses_total Authenticated user cache misses.',
+        '# TYPE user_cache_misses_total counter',
+        f'user_cache_misses_total{{pid="{pid}"}} {users["misses"]}',
+        '# HELP report_jobs_running Report jobs currently running in all processes.',
+        '# TYPE report_jobs_running gauge',
+        f"report_jobs_running {reports['running']}",
+        '# HELP report_jobs_queued Report jobs waiting to start in all processes.',
+        '# TYPE report_jobs_queued gauge',
+        f"report_jobs_queued {reports['queued']}",
+    ]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+
+""" Fábrica de la aplicación. Crea una aplicación Flask, establece la clave secreta y la
+ configuración (la URI de la base de datos sale de la variable de entorno DATABASE_URL o es
+ instance/database.db por defecto) y le asocia la base de datos, las rutas y los comandos
+ de consola. No toca la base de datos ni importa plotly, así que crearla es barato; el
+ esquema se crea con "flask --app main migrate". config permite sobrescribir valores. """
+def create_app(config=None):
+    app = Flask(__name__)
+    app.secret_key = 'mysecretkey'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///database.db')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10, 'max_overflow': 10}
+    app.config['SQLITE_JOURNAL_MODE'] = 'WAL'
+    app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'
+    app.config['SQLITE_BUSY_TIMEOUT'] = 5000
+    app.config['CHART_CACHE_SIZE'] = 32
+    app.config['PLOTLY_JS_FILENAME'] = 'plotly.min.js'
+    app.config['PLOTLY_JS_VERSION'] = importlib.metadata.version('plotly')
+    app.config['PLOTLY_JS_MAX_AGE'] = 31536000
+    app.config['DASHBOARD_PAGE_SIZE'] = 50
+    app.config['DASHBOARD_MAX_PAGE_SIZE'] = 500
+    app.config['SALES_BATCH_CHUNK_SIZE'] = 5000
+    app.config['LOW_STOCK_THRESHOLD'] = 0.9
+    app.config['PRODUCT_SEARCH_LIMIT'] = 20
+    app.config['PRODUCT_SEARCH_MAX_LIMIT'] = 100
+    app.config['PRODUCT_SEARCH_CANDIDATES'] = 200
+    app.config['EXPORT_BATCH_SIZE'] = 1000
+    app.config['EXPORT_GZIP_LEVEL'] = 6
+    app.config['COMPRESS_MIN_SIZE'] = 1024
+    app.config['COMPRESS_GZIP_LEVEL'] = 6
+    app.config['COMPRESS_BROTLI_QUALITY'] = 5
+    app.config['REPORT_MAX_WORKERS'] = 2
+    app.config['REPORT_KEEP_JOBS'] = 5
+    app.config['REPORT_MIN_INTERVALS'] = {'default': 60, 'supplier_totals': 10, 'restock_forecast': 900}
+    app.config['REPORT_JOB_TIMEOUT'] = 1800
+    app.config['REPORT_RETRY_SECONDS'] = 5
+    app.config['REPORT_ON_DATA_CHANGE'] = True
+    app.config['REPORT_NOTIFY_INTERVAL'] = 5
+    app.config['REPORT_TOP_PRODUCTS'] = 20
+    app.config['FORECAST_WINDOW_DAYS'] = 90
+    app.config['FORECAST_HALF_LIFE_DAYS'] = 14
+    app.config['FORECAST_LEAD_TIME_DAYS'] = 7
+    app.config['FORECAST_COVER_DAYS'] = 14
+    app.config['FORECAST_SERVICE_Z'] = 1.65
+    app.config['FORECAST_BATCH_SIZE'] = 100000
+    app.config['FORECAST_MAX_PRODUCTS'] = 500
+    app.config['FORECAST_DASHBOARD_ROWS'] = 20
+    app.config['USER_CACHE_SIZE'] = 1024
+    app.config['USER_CACHE_TTL'] = 300
+    app.config['SLOW_REQUEST_LOG_MS'] = float(os.environ['SLOW_REQUEST_LOG_MS']) if os.environ.get('SLOW_REQUEST_LOG_MS') else None
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+    with app.app_context():
+        configure_sqlite(db.engine, app.config)
+
+    app.extensions['chart_cache'] = ChartCache(app.config['CHART_CACHE_SIZE'])
+    app.extensions['user_cache'] = UserCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+    app.extensions['report_runner'] = ReportRunner(app, app.config['REPORT_MAX_WORKERS'], app.config['REPORT_MIN_INTERVALS'],
+                                                   app.config['REPORT_JOB_TIMEOUT'], app.config['REPORT_RETRY_SECONDS'],
+                                                   app.config['REPORT_NOTIFY_INTERVAL'])
+    app.extensions['request_metrics'] = RequestMetrics(app)
+
+    app.register_blueprint(bp)
+    app.context_processor(inject_plotly_js)
+    app.after_request(cache_plotly_js)
+    app.after_request(compress_response)
+
+    for command in (migrate_command, rebuild_stats_command, vendor_plotly_command, refresh_reports_command):
+        app.cli.add_command(command)
+    return app
+
+
+""" Precarga de módulos pesados. Por defecto plotly se importa la primera vez que se pide un
+ gráfico y NumPy (con forecast) la primera vez que se calcula la previsión de reposición.
+ Cuando se arranca con gunicorn --preload (ver gunicorn.conf.py), el proceso maestro llama
+ a esta función antes de crear los workers, que comparten así por copy-on-write la memoria
+ de estos módulos en lugar de importarlos cada uno. """
+def preload_heavy_modules(app):
+    import forecast
+    import plotly.graph_objects
+    import plotly.offline
+    import plotly.subplots
+
+    with app.app_context():
+        write_plotly_js()
+
+
+""" Aplicación por defecto, usada por "flask --app main", "gunicorn main:app" y la ejecución
+ directa del archivo. """
+app = create_app()
 
 
 """ Esta línea verifica si el archivo se está ejecutando directamente y, en ese caso, 
- inicia la aplicación Flask en modo de depuración. """
+ crea o migra la base de datos e inicia la aplicación Flask en modo de depuración. """
 if __name__ == '__main__':
+    with app.app_context():
+        init_database()
     app.run(debug=True)
@@ -0,0 +1,142 @@
+# Instrumentación de peticiones: latencia por ruta, consultas SQL y tiempo de plantillas.
+from flask import current_app, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import defaultdict
+import os
+import threading
+import time
+
+
+""" Límites (en segundos) de los cubos del histograma de latencia. """
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestMetrics:
+    """ Clase RequestMetrics.
+    Recoge métricas de cada petición mediante los hooks before/after request de Flask, los
+    eventos de ejecución de SQLAlchemy y las señales de renderizado de plantillas, y las
+    acumula por ruta (endpoint) para exponerlas en formato de texto de Prometheus.
+    Los contadores son del proceso: con varios workers de gunicorn cada uno tiene los suyos,
+    y todas las series llevan la etiqueta pid para no mezclarlos.
+    Si SLOW_REQUEST_LOG_MS tiene valor, las peticiones más lentas que ese umbral se registran
+    en el log de la aplicación junto con las sentencias SQL que ejecutaron.
+    args:
+      -app: Es la aplicación Flask que se instrumenta; puede indicarse más tarde con init_app."""
+
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.latency_buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.latency_sum = defaultdict(float)
+        self.latency_count = defaultdict(int)
+        self.sql_queries = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+        self.template_seconds = defaultdict(float)
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('SLOW_REQUEST_LOG_MS', None)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql_queries = 0
+        g.metrics_sql_seconds = 0.0
+        g.metrics_template_seconds = 0.0
+        g.metrics_template_started = []
+        g.metrics_statements = [] if self.app.config['SLOW_REQUEST_LOG_MS'] is not None else None
+
+    def _after_request(self, response):
+        if 'metrics_started' not in g:
+            return response
+
+        elapsed = time.perf_counter() - g.metrics_started
+        endpoint = request.endpoint or 'unknown'
+        method = request.method
+
+        with self._lock:
+            self.requests[(endpoint, method, response.status_code)] += 1
+            buckets = self.latency_buckets[(endpoint, method)]
+            for index, limit in enumerate(LATENCY_BUCKETS):
+                if elapsed <= limit:
+                    buckets[index] += 1
+            self.latency_sum[(endpoint, method)] += elapsed
+            self.latency_count[(endpoint, method)] += 1
+            self.sql_queries[endpoint] += g.metrics_sql_queries
+            self.sql_seconds[endpoint] += g.metrics_sql_seconds
+            self.template_seconds[endpoint] += g.metrics_template_seconds
+
+        threshold = self.app.config['SLOW_REQUEST_LOG_MS']
+        if threshold is not None and elapsed * 1000 >= threshold:
+            statements = '\n'.join(f'  {duration * 1000:.2f} ms  {statement}' for statement, duration in g.metrics_statements)
+            self.app.logger.warning(
+                'Slow request %s %s: %.1f ms, %d queries (%.1f ms SQL), %.1f ms templates\n%s',
+                method, request.full_path.rstrip('?'), elapsed * 1000, g.metrics_sql_queries, g.metrics_sql_seconds * 1000,
+                g.metrics_template_seconds * 1000, statements)
+        return response
+
+    def _before_render(self, sender, template, context, **extra):
+        if 'metrics_template_started' in g:
+            g.metrics_template_started.append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        if g.get('metrics_template_started'):
+            g.metrics_template_seconds += time.perf_counter() - g.metrics_template_started.pop()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['metrics_query_started'].pop()
+        # Los eventos del motor son globales: solo cuenta la petición de su propia aplicación
+        if not has_request_context() or current_app._get_current_object() is not self.app or 'metrics_started' not in g:
+            return
+
+        duration = time.perf_counter() - started
+        g.metrics_sql_queries += 1
+        g.metrics_sql_seconds += duration
+        if g.metrics_statements is not None:
+            g.metrics_statements.append((statement, duration))
+
+    def render_prometheus(self):
+        # Devuelve las métricas acumuladas en el formato de texto de Prometheus, con la
+        # etiqueta pid del proceso en todas las series
+        pid = os.getpid()
+        lines = []
+        with self._lock:
+            lines.append('# HELP http_requests_total Requests served, by endpoint, method and status.')
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{pid="{pid}",endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+
+            lines.append('# HELP http_request_duration_seconds Request latency, by endpoint and method.')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for (endpoint, method), buckets in sorted(self.latency_buckets.items()):
+                labels = f'pid="{pid}",endpoint="{endpoint}",method="{method}"'
+                for limit, count in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{limit}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {self.latency_count[(endpoint, method)]}')
+                lines.append(f'http_request_duration_seconds_sum{{{labels}}} {self.latency_sum[(endpoint, method)]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{{labels}}} {self.latency_count[(endpoint, method)]}')
+
+            for name, help_text, values, fmt in (
+                ('http_request_sql_queries_total', 'SQL statements executed while serving requests.', self.sql_queries, '{}'),
+                ('http_request_sql_seconds_total', 'Time spent in SQL while serving requests.', self.sql_seconds, '{:.6f}'),
+                ('http_request_template_seconds_total', 'Time spent rendering templates.', self.template_seconds, '{:.6f}'),
+            ):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for endpoint, value in sorted(values.items()):
+                    lines.append(f'{name}{{pid="{pid}",endpoint="{endpoint}"}} ' + fmt.format(value))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,64 @@
+# Prueba de concurrencia de add_sale: muchas ventas simultáneas sobre el mismo producto no
+# pueden vender más unidades de las que hay en stock.
+import threading
+
+import pytest
+
+import main
+
+
+INITIAL_STOCK = 100
+THREADS = 16
+POSTS_PER_THREAD = 25
+
+
+@pytest.fixture
+def app(tmp_path):
+    # Sin informes en segundo plano: la prueba no debe arrancar el pool de procesos en cada venta
+    app = main.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'database.db'}", 'TESTING': True,
+                           'REPORT_ON_DATA_CHANGE': False})
+    with app.app_context():
+        main.init_database()
+        supplier = main.Supplier(company_name='Proveedor', phone='600000000', address='Calle 1', cif='B00000000')
+        main.db.session.add(supplier)
+        main.db.session.flush()
+        main.db.session.add(main.Product(name='Producto', description='Producto de prueba', precio_costo=1.0,
+                                         precio_venta=2.0, stock=INITIAL_STOCK, quantity=INITIAL_STOCK,
+                                         supplier_id=supplier.id))
+        main.db.session.add(main.User(username='admin', password='admin', email='admin@example.com', is_admin=True))
+        main.db.session.commit()
+    return app
+
+
+def test_concurrent_sales_never_oversell(app):
+    with app.app_context():
+        product_id = main.Product.query.one().id
+
+    barrier = threading.Barrier(THREADS)
+    failures = []
+
+    def sell():
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin'})
+        barrier.wait()
+        for _ in range(POSTS_PER_THREAD):
+            response = client.post('/add_sale', data={'product': product_id, 'quantity': 1})
+            if response.status_code != 302:
+                failures.append(response.status_code)
+
+    threads = [threading.Thread(target=sell) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert failures == []
+    with app.app_context():
+        stock = main.db.session.get(main.Product, product_id).stock
+        sold = main.db.session.query(main.db.func.coalesce(main.db.func.sum(main.Sale.quantity), 0)).scalar()
+        stats = main.db.session.get(main.SupplierStats, main.Product.query.one().supplier_id)
+
+        assert stock == 0
+        assert sold == INITIAL_STOCK
+        assert stock + sold == INITIAL_STOCK
+        assert stats.units_sold == sold